@@ -1,32 +1,238 @@
-from django.contrib import admin
+import hashlib
 
-from .models import Test, Stimulus, Response, Questionary
+from django.contrib import admin, messages
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Count, ForeignKey, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.forms.models import BaseInlineFormSet
+from django.utils.functional import cached_property
 
+from din import jobs
+from .models import Test, Stimulus, Response, Questionary, TestSession, SessionSummary, Job
 
-def make_readonly(mod, extra_fields=None):
+
+def count_of(model, field: str):
+    """The number of rows of ``model`` pointing to the row through ``field``.
+
+    A subquery instead of a join, so only the rows of the page are counted.
+    """
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef("pk")})
+        .order_by()
+        .values(field)
+        .annotate(n=Count("pk"))
+        .values("n"),
+        output_field=IntegerField(),
+    ), 0)
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator reusing the row count of the same query for ``timeout`` seconds.
+
+    Counting a large table takes a full scan on SQLite, which the changelist
+    would otherwise do for every page.
+    """
+    timeout = 60
+
+    @cached_property
+    def count(self):
+        sql, params = self.object_list.query.sql_with_params()
+        key = "admin-count:" + hashlib.sha256(f"{sql} {params}".encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = super().count
+            cache.set(key, count, self.timeout)
+        return count
+
+
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """The rows of one page of an inline, newest first.
+
+    One row past the page is fetched to tell whether there is a next page,
+    so the rows are never counted.
+    """
+    per_page = 20
+    page = 1
+    has_next = False
+
+    def get_queryset(self):
+        if not hasattr(self, "_queryset"):
+            start = (self.page - 1) * self.per_page
+            rows = list(super().get_queryset().order_by("-pk")[start:start + self.per_page + 1])
+            self.has_next = len(rows) > self.per_page
+            self._queryset = rows[:self.per_page]
+        return self._queryset
+
+
+def get_foreign_keys(mod) -> list[str]:
+    return [field.name for field in mod._meta.fields if isinstance(field, ForeignKey)]
+
+
+def make_readonly(mod, extra_fields=None, per_page: int = 20):
     class ReadOnlyInline(admin.TabularInline):
         model = mod
         extra = 0
         max_num = 0
         show_change_link = True
-        readonly_fields = tuple([f.name for f in mod._meta.fields] + 
+        can_delete = False
+        readonly_fields = tuple([f.name for f in mod._meta.fields] +
             (extra_fields if extra_fields else []))
+        formset = PaginatedInlineFormSet
+        template = "admin/din/paginated_tabular.html"
+
+        def get_queryset(self, request):
+            return super().get_queryset(request).select_related(*get_foreign_keys(mod))
+
+        def get_formset(self, request, obj=None, **kwargs):
+            formset = super().get_formset(request, obj, **kwargs)
+            param = f"{formset.get_default_prefix()}_page"
+            try:
+                page = max(int(request.GET.get(param, 1)), 1)
+            except ValueError:
+                page = 1
+
+            def page_url(n):
+                query = request.GET.copy()
+                query[param] = n
+                return f"?{query.urlencode()}"
+
+            formset.per_page, formset.page = per_page, page
+            formset.previous_url = page_url(page - 1) if page > 1 else None
+            formset.next_url = page_url(page + 1)
+            return formset
 
     return ReadOnlyInline
 
-def register_with_inline(mod, inline_mods, excludes = None, extra_fields = None, search_fieldset = ()):
+
+class ScalableAdmin(admin.ModelAdmin):
+    """Changelists that stay fast on large tables.
+
+    Foreign keys are fetched with the rows and edited by id, and the result
+    count is cached instead of counting the whole table again.
+    """
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+    def __init__(self, model, admin_site):
+        super().__init__(model, admin_site)
+        foreign_keys = get_foreign_keys(model)
+        self.list_select_related = [name for name in foreign_keys if name in self.list_display]
+        self.raw_id_fields = foreign_keys
+
+
+def register_with_inline(mod, inline_mods, excludes = None, extra_fields = None, search_fieldset = (),
+                         base=ScalableAdmin, list_filters=()):
     @admin.register(mod)
-    class AdminModel(admin.ModelAdmin):
+    class AdminModel(base):
         inlines = inline_mods
         list_display_links = list_display = [
             field.name
             for field in mod._meta.fields
+            if field.name not in getattr(base, "list_exclude", ())
         ] + (extra_fields if extra_fields else [])
-        search_fields = search_fieldset 
+        list_filter = list_filters
+        search_fields = search_fieldset
         exclude = excludes
 
+    return AdminModel
+
+
+def queue_summaries(summaries):
+    for summary in summaries:
+        jobs.enqueue(
+            "summary", f"summary:{summary.questionary_id}:{summary.test_id}",
+            questionary=summary.questionary_id, test=summary.test_id,
+        )
+
+
+class TestAdmin(ScalableAdmin):
+    actions = ["activate", "deactivate", "recompute_summaries"]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_stats().annotate(stimulus_count=count_of(Stimulus, "test"))
+
+    @admin.display(description="stimuli", ordering="stimulus_count")
+    def stimuli(self, obj):
+        return obj.stimulus_count
+
+    @admin.display(description="responses", ordering="response_count")
+    def responses(self, obj):
+        return obj.response_count or 0
+
+    @admin.display(description="completed", ordering="completed_count")
+    def completed(self, obj):
+        return obj.completed_count or 0
+
+    @admin.action(description="Activate selected tests")
+    def activate(self, request, queryset):
+        n = queryset.update(active=True)
+        self.message_user(request, f"Activated {n} tests.", messages.SUCCESS)
+
+    @admin.action(description="Deactivate selected tests")
+    def deactivate(self, request, queryset):
+        n = queryset.update(active=False)
+        self.message_user(request, f"Deactivated {n} tests.", messages.SUCCESS)
+
+    @admin.action(description="Recompute the summaries of selected tests")
+    def recompute_summaries(self, request, queryset):
+        for pk in queryset.values_list("pk", flat=True):
+            jobs.enqueue("summarize_test", f"summarize_test:{pk}", test=pk)
+        self.message_user(request, "Queued the summaries of the selected tests.", messages.SUCCESS)
+
+
+class StimulusAdmin(ScalableAdmin):
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(response_count=count_of(Response, "stimulus"))
+
+    @admin.display(description="responses", ordering="response_count")
+    def responses(self, obj):
+        return obj.response_count
+
+
+class QuestionaryAdmin(ScalableAdmin):
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            response_count=count_of(Response, "questionary"),
+            summary_count=count_of(SessionSummary, "questionary"),
+        )
+
+    @admin.display(description="responses", ordering="response_count")
+    def responses(self, obj):
+        return obj.response_count
+
+    @admin.display(description="completed", ordering="summary_count")
+    def completed(self, obj):
+        return obj.summary_count
+
+
+class SessionSummaryAdmin(ScalableAdmin):
+    # the fits and per question lists are too long for a column
+    list_exclude = ("digit_fit", "triplet_fit", "levels", "n_correct")
+    actions = ["recompute"]
+
+    @admin.action(description="Recompute selected summaries")
+    def recompute(self, request, queryset):
+        queue_summaries(queryset.only("questionary", "test"))
+        self.message_user(request, "Queued the selected summaries.", messages.SUCCESS)
+
+
+class JobAdmin(ScalableAdmin):
+    list_exclude = ("args", "result", "error")
+    readonly_fields = [field.name for field in Job._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
 
-register_with_inline(Test,())# (make_readonly(Stimulus), ))
-register_with_inline(Stimulus, (make_readonly(Response), ))
-register_with_inline(Questionary, ( ))
-register_with_inline(Response, ())
\ No newline at end of file
+register_with_inline(Test, (), extra_fields=["stimuli", "responses", "completed"], base=TestAdmin,
+                     list_filters=("active",))
+register_with_inline(Stimulus, (make_readonly(Response), ), extra_fields=["responses"], base=StimulusAdmin,
+                     list_filters=("test", ))
+register_with_inline(Questionary, (make_readonly(SessionSummary), ), extra_fields=["responses", "completed"],
+                     base=QuestionaryAdmin)
+register_with_inline(Response, (), list_filters=("test", ))
+register_with_inline(TestSession, (), list_filters=("test", ))
+register_with_inline(SessionSummary, (), base=SessionSummaryAdmin, list_filters=("test", ))
+register_with_inline(Job, (), search_fieldset=("key", ), base=JobAdmin, list_filters=("status", "kind"))
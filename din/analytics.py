@@ -0,0 +1,149 @@
+import itertools
+
+import numpy as np
+
+from din.models import Test, Response, SessionSummary
+
+RESPONSE_COLUMNS = (
+    ("test", "test_id", np.int64),
+    ("questionary", "questionary_id", np.int64),
+    ("index", "index", np.int16),
+    ("level", "stimulus__level", np.int16),
+    ("label", "stimulus__label", "S3"),
+    ("answer", "answer", "S3"),
+    ("age", "questionary__age", np.int16),
+    ("first_time", "questionary__first_time", bool),
+)
+
+
+def load_responses(responses=None, chunk_size: int = 50_000) -> dict:
+    """Stream responses into contiguous, columnar NumPy arrays.
+
+    Rows are sorted by (test, questionary, index), so the responses of a
+    session are a contiguous segment of every column. Rows are converted a
+    chunk at a time, so no Python object is kept per response.
+    """
+    if responses is None:
+        responses = Response.objects.all()
+
+    fields = [field for _, field, _ in RESPONSE_COLUMNS]
+    rows = responses.filter(stimulus__isnull=False).order_by(
+        "test", "questionary", "index"
+    ).values_list(*fields).iterator(chunk_size=chunk_size)
+
+    chunks = {name: [] for name, *_ in RESPONSE_COLUMNS}
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            break
+        for (name, _, dtype), column in zip(RESPONSE_COLUMNS, zip(*chunk)):
+            if dtype == "S3":
+                column = [value.encode() for value in column]
+            chunks[name].append(np.array(column, dtype=dtype))
+
+    columns = {}
+    for name, _, dtype in RESPONSE_COLUMNS:
+        columns[name] = (
+            np.concatenate(chunks[name]) if chunks[name] else np.array([], dtype=dtype)
+        )
+
+    label = columns["label"].view(np.uint8).reshape(-1, 3)
+    answer = columns["answer"].view(np.uint8).reshape(-1, 3)
+    columns["n_correct"] = ((label == answer) & (answer != 0)).sum(axis=1).astype(np.int8)
+    columns["correct"] = columns["label"] == columns["answer"]
+    return columns
+
+
+def get_sessions(columns: dict, completed: bool = True) -> dict:
+    """Group the columnar responses into sessions and compute their SRTs.
+
+    A session is a (test, questionary) segment of the columns; ``start`` and
+    ``stop`` index into the response columns. With ``completed``, only sessions
+    with exactly ``Test.n_questions`` responses are kept.
+    """
+    test, questionary = columns["test"], columns["questionary"]
+    n_rows = len(test)
+    new_session = np.ones(n_rows, dtype=bool)
+    new_session[1:] = (test[1:] != test[:-1]) | (questionary[1:] != questionary[:-1])
+    start = np.flatnonzero(new_session)
+    stop = np.r_[start[1:], n_rows].astype(start.dtype)
+
+    test_ids = test[start]
+    tests = {
+        t.pk: t for t in Test.objects.filter(pk__in=np.unique(test_ids).tolist())
+    }
+
+    def per_test(attr, dtype=np.int64):
+        return np.array([getattr(tests[pk], attr) for pk in test_ids], dtype=dtype)
+
+    n_questions = per_test("n_questions")
+    if completed:
+        keep = (stop - start) == n_questions
+        start, stop, test_ids, n_questions = start[keep], stop[keep], test_ids[keep], n_questions[keep]
+
+    increment = per_test("increment")
+    last = stop - 1
+    levels = columns["level"].astype(np.float64)
+    next_level = np.where(
+        columns["correct"][last],
+        np.maximum(levels[last] - increment, per_test("min_level")),
+        np.minimum(levels[last] + increment, per_test("max_level")),
+    )
+
+    cumulative = np.r_[0.0, np.cumsum(levels)]
+    first = np.maximum(start, stop - 20)
+    srt = (cumulative[stop] - cumulative[first] + next_level) / (stop - first + 1)
+
+    return {
+        "start": start,
+        "stop": stop,
+        "test": test_ids,
+        "audio_generator": per_test("audio_generator", object),
+        "questionary": questionary[start],
+        "age": columns["age"][start],
+        "first_time": columns["first_time"][start],
+        "srt": srt,
+    }
+
+
+def load_sessions(tests=None, completed: bool = True, chunk_size: int = 50_000):
+    responses = Response.objects.all()
+    if tests is not None:
+        responses = responses.filter(test__in=tests)
+    columns = load_responses(responses, chunk_size)
+    return columns, get_sessions(columns, completed)
+
+
+def summarize_sessions(tests=None, force: bool = False) -> int:
+    """Store the summaries of the completed sessions of ``tests`` that have none.
+
+    With ``force``, existing summaries are recomputed. Returns the number stored.
+    """
+    if tests is None:
+        tests = Test.objects.all()
+
+    existing = set()
+    if not force:
+        existing = set(SessionSummary.objects.filter(
+            test__in=tests).values_list("questionary", "test"))
+
+    columns, sessions = load_sessions(tests)
+    n_stored = 0
+    for questionary_id, test_id, start, stop, srt in zip(
+        sessions["questionary"].tolist(),
+        sessions["test"].tolist(),
+        sessions["start"],
+        sessions["stop"],
+        sessions["srt"],
+    ):
+        if (questionary_id, test_id) in existing:
+            continue
+        SessionSummary.store(
+            questionary_id,
+            test_id,
+            columns["level"][start:stop],
+            columns["n_correct"][start:stop],
+            srt,
+        )
+        n_stored += 1
+    return n_stored
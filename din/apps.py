@@ -7,4 +7,13 @@ class DinConfig(AppConfig):
 
     
     def ready(self):
-        pass
\ No newline at end of file
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_save, post_delete
+        from din.catalog import invalidate_test, invalidate_stimulus
+        from din.metrics import install_recorder
+        from din.models import Test, Stimulus
+
+        for signal in (post_save, post_delete):
+            signal.connect(invalidate_test, sender=Test)
+            signal.connect(invalidate_stimulus, sender=Stimulus)
+        connection_created.connect(install_recorder)
@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+import numpy as np
+
+from din.models import Stimulus, Test
+
+
+class TestStimuli:
+    """The stimuli of a single test, stored as arrays per level."""
+
+    def __init__(self, test: Test):
+        self.test = test
+        self.levels = {}
+        rows = Stimulus.objects.filter(test=test).values_list("pk", "level", "label", "name")
+        by_level = {}
+        for pk, level, label, name in rows:
+            by_level.setdefault(level, []).append((pk, label, name))
+        for level, stimuli in by_level.items():
+            pks, labels, names = zip(*stimuli)
+            self.levels[level] = (
+                np.array(pks, dtype=np.int64),
+                np.array(labels, dtype="U3"),
+                np.array(names, dtype=object),
+            )
+
+    def sample(self, level: int, exclude=(), max_tries: int = 8) -> Stimulus:
+        pks, labels, names = self.levels[level]
+        exclude = set(exclude)
+
+        for _ in range(max_tries):
+            i = random.randrange(len(pks))
+            if labels[i] not in exclude:
+                break
+        else:
+            candidates = np.flatnonzero(~np.isin(labels, list(exclude)))
+            i = random.choice(candidates) if len(candidates) else random.randrange(len(pks))
+
+        return self._stimulus(level, i)
+
+    def get(self, level: int, pk: int):
+        pks = self.levels[level][0]
+        i = np.flatnonzero(pks == pk)
+        if len(i) == 0:
+            return None
+        return self._stimulus(level, i[0])
+
+    def _stimulus(self, level: int, i: int) -> Stimulus:
+        pks, labels, names = self.levels[level]
+        return Stimulus(
+            pk=int(pks[i]), test=self.test, level=level, label=str(labels[i]), name=names[i]
+        )
+
+
+class StimulusCatalog:
+    """Process local cache of the stimuli of each test.
+
+    Entries are dropped when a test or one of its stimuli is saved or deleted
+    in this process, and expire after ``ttl`` seconds to pick up changes made
+    by other processes.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self.tests = {}
+        self.lock = threading.Lock()
+
+    def get(self, test: Test) -> TestStimuli:
+        entry = self.tests.get(test.pk)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            entry = (time.monotonic(), TestStimuli(test))
+            with self.lock:
+                self.tests[test.pk] = entry
+        return entry[1]
+
+    def sample(self, test: Test, level: int, exclude=()) -> Stimulus:
+        return self.get(test).sample(level, exclude)
+
+    def invalidate(self, test_id=None):
+        with self.lock:
+            if test_id is None:
+                self.tests.clear()
+            else:
+                self.tests.pop(test_id, None)
+
+
+catalog = StimulusCatalog()
+
+
+def invalidate_test(sender, instance, **kwargs):
+    catalog.invalidate(instance.pk)
+
+
+def invalidate_stimulus(sender, instance, **kwargs):
+    catalog.invalidate(instance.test_id)
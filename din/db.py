@@ -0,0 +1,62 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction
+
+from django.db import connection, OperationalError
+
+logger = logging.getLogger(__name__)
+
+# set on the response of a request that failed because the database stayed locked
+LOCKED_HEADER = "X-Database-Locked"
+
+
+def is_locked(err: OperationalError) -> bool:
+    return "database is locked" in str(err) or "database table is locked" in str(err)
+
+
+def retry_on_locked(func=None, *, attempts: int = 5, delay: float = 0.05):
+    """Retry a write that failed because SQLite was locked by another worker.
+
+    The busy timeout already makes SQLite wait for the lock, this covers the
+    cases where it gives up. Waits grow exponentially with some jitter. Inside
+    an outer transaction the error is raised, as only the outermost block can
+    be retried.
+    """
+    if func is None:
+        return functools.partial(retry_on_locked, attempts=attempts, delay=delay)
+
+    def should_retry(err, attempt):
+        if not is_locked(err) or connection.in_atomic_block or attempt == attempts - 1:
+            return False
+        logger.info("database locked in %s, retry %d", func.__qualname__, attempt + 1)
+        return True
+
+    def wait(attempt):
+        return delay * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    if iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return await func(*args, **kwargs)
+                except OperationalError as err:
+                    if not should_retry(err, attempt):
+                        raise
+                    await asyncio.sleep(wait(attempt))
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as err:
+                if not should_retry(err, attempt):
+                    raise
+                time.sleep(wait(attempt))
+    return wrapper
@@ -0,0 +1,245 @@
+import csv
+import io
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Exists, OuterRef
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+
+from din.models import Response, SessionSummary
+
+# (column, queryset field, type) per export, types are mapped to arrow types
+# for parquet. Computed columns have no field and are filled in by ``iter_rows``.
+EXPORTS = {
+    "responses": (
+        Response.objects.filter(stimulus__isnull=False).order_by("test", "questionary", "index"),
+        (
+            ("test", "test_id", "int"),
+            ("test_name", "test__audio_generator", "str"),
+            ("questionary", "questionary_id", "int"),
+            ("index", "index", "int"),
+            ("level", "stimulus__level", "int"),
+            ("label", "stimulus__label", "str"),
+            ("answer", "answer", "str"),
+            ("n_correct", None, "int"),
+            ("age", "questionary__age", "int"),
+            ("first_time", "questionary__first_time", "bool"),
+            ("normal_hearing", "questionary__normal_hearing", "bool"),
+            ("first_language", "questionary__first_language", "bool"),
+        ),
+    ),
+    "sessions": (
+        SessionSummary.objects.order_by("test", "questionary"),
+        (
+            ("test", "test_id", "int"),
+            ("test_name", "test__audio_generator", "str"),
+            ("questionary", "questionary_id", "int"),
+            ("completed_at", "completed_at", "datetime"),
+            ("srt", "srt", "float"),
+            ("digit_x50", "digit_x50", "float"),
+            ("triplet_x50", "triplet_x50", "float"),
+            ("age", "questionary__age", "int"),
+            ("first_time", "questionary__first_time", "bool"),
+            ("normal_hearing", "questionary__normal_hearing", "bool"),
+            ("first_language", "questionary__first_language", "bool"),
+            ("levels", "levels", "list"),
+            ("n_correct", "n_correct", "list"),
+        ),
+    ),
+}
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def get_rows(kind: str, tests=None, active=None, start=None, end=None):
+    """The queryset of an export, filtered by test ids, active flag and completion date.
+
+    Responses are filtered on the completion date of their session, so with
+    a date range only completed sessions are exported.
+    """
+    if kind not in EXPORTS:
+        raise ValueError(f"Unknown export {kind}, choose from {list(EXPORTS)}")
+    queryset, columns = EXPORTS[kind]
+    if tests:
+        queryset = queryset.filter(test__in=tests)
+    if active is not None:
+        queryset = queryset.filter(test__active=active)
+
+    completed_at = {}
+    if start is not None:
+        completed_at["completed_at__date__gte"] = start
+    if end is not None:
+        completed_at["completed_at__date__lte"] = end
+    if completed_at and kind == "sessions":
+        queryset = queryset.filter(**completed_at)
+    elif completed_at:
+        queryset = queryset.filter(Exists(SessionSummary.objects.filter(
+            questionary=OuterRef("questionary"), test=OuterRef("test"), **completed_at)))
+    return queryset, columns
+
+
+def iter_rows(kind: str, chunk_size: int = 10_000, **filters):
+    """Stream the rows of an export as tuples, holding at most a chunk in memory."""
+    queryset, columns = get_rows(kind, **filters)
+    fields = [field for _, field, _ in columns if field is not None]
+    rows = queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+    if kind == "responses":
+        i_label, i_answer = fields.index("stimulus__label"), fields.index("answer")
+        i_n_correct = [name for name, *_ in columns].index("n_correct")
+        for row in rows:
+            n_correct = sum(a == c for a, c in zip(row[i_answer], row[i_label]))
+            yield (*row[:i_n_correct], n_correct, *row[i_n_correct:])
+    else:
+        yield from rows
+
+
+class _Buffer:
+    """Write only file object handing out what was written since the last ``drain``."""
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_csv(columns, rows, chunk_size: int = 10_000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, *_ in columns])
+    lists = [i for i, (*_, kind) in enumerate(columns) if kind == "list"]
+    for chunk in iter(lambda: list(itertools.islice(rows, chunk_size)), []):
+        for row in chunk:
+            if lists:
+                row = list(row)
+                for i in lists:
+                    row[i] = json.dumps(row[i])
+            writer.writerow(row)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def iter_parquet(columns, rows, chunk_size: int = 10_000):
+    """Write the rows as a parquet file with a row group per chunk."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as err:
+        raise ImportError("Parquet exports require pyarrow, pip install pyarrow") from err
+
+    types = {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "str": pa.string(),
+        "datetime": pa.timestamp("us", tz="UTC"),
+        "list": pa.list_(pa.int64()),
+    }
+    schema = pa.schema([(name, types[kind]) for name, _, kind in columns])
+
+    def write():
+        buffer = _Buffer()
+        with pq.ParquetWriter(buffer, schema) as writer:
+            for chunk in iter(lambda: list(itertools.islice(rows, chunk_size)), []):
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(zip(*chunk), schema)],
+                    schema=schema,
+                ))
+                yield buffer.drain()
+        yield buffer.drain()
+    return write()
+
+
+WRITERS = {
+    "csv": iter_csv,
+    "parquet": iter_parquet,
+}
+
+
+def iter_export(kind: str, fmt: str, chunk_size: int = 10_000, **filters):
+    """The encoded chunks of an export in ``fmt``."""
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown format {fmt}, choose from {list(WRITERS)}")
+    _, columns = EXPORTS[kind]
+    rows = iter_rows(kind, chunk_size, **filters)
+    return WRITERS[fmt](columns, rows, chunk_size)
+
+
+async def aiter_chunks(chunks):
+    """The chunks of a sync export as an async iterator.
+
+    Under ASGI Django reads a sync iterator to the end before sending it, so
+    the chunks are produced one at a time on the sync thread instead, where
+    the database cursor of the export lives.
+    """
+    next_chunk = sync_to_async(next)
+    done = object()
+    while (chunk := await next_chunk(chunks, done)) is not done:
+        yield chunk
+
+
+def get_date(value: str):
+    """The date of a ``YYYY-MM-DD`` parameter, ``None`` when it is empty."""
+    if not value:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(f"Invalid date {value}")
+    return date
+
+
+def get_filters(params) -> dict:
+    active = params.get("active")
+    return {
+        "tests": [int(pk) for pk in params.getlist("test") if pk.isdigit()],
+        "active": None if active in (None, "") else active.lower() in ("1", "true", "yes"),
+        "start": get_date(params.get("start")),
+        "end": get_date(params.get("end")),
+    }
+
+
+@staff_member_required
+def export_view(request, kind: str, fmt: str):
+    """Stream an export, filtered by ``?test=<id>&active=1&start=<date>&end=<date>``."""
+    if kind not in EXPORTS or fmt not in WRITERS:
+        raise Http404(f"Unknown export {kind}.{fmt}")
+    try:
+        filters = get_filters(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid date, use YYYY-MM-DD", content_type="text/plain")
+    try:
+        chunks = iter_export(kind, fmt, **filters)
+    except ImportError as err:
+        return HttpResponse(str(err), status=501, content_type="text/plain")
+    if isinstance(request, ASGIRequest):
+        chunks = aiter_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type=CONTENT_TYPES[fmt])
+    response["Content-Disposition"] = f'attachment; filename="{kind}.{fmt}"'
+    return response
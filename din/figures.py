@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+# Bump when the plotting code changes, so cached figures are re-rendered
+FIGURE_VERSION = 1
+
+
+def get_key(name: str, *data) -> str:
+    payload = json.dumps([FIGURE_VERSION, name, *data], default=float)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def get_pyplot():
+    """pyplot on the Agg backend, imported on first use.
+
+    Only the processes that render figures pay for importing matplotlib.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+class FigureCache:
+    """Size bounded, least recently used on-disk cache of rendered figures."""
+
+    def __init__(self, root, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def path(self, key: str, fmt: str) -> Path:
+        return self.root / f"{key}.{fmt}"
+
+    def has(self, key: str, fmt: str) -> bool:
+        return self.path(key, fmt).exists()
+
+    def get(self, key: str, fmt: str):
+        path = self.path(key, fmt)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key: str, fmt: str, data: bytes):
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path(key, fmt))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.root.iterdir():
+            if path.suffix[1:] not in CONTENT_TYPES:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def get_or_render(self, key: str, fmt: str, render) -> bytes:
+        data = self.get(key, fmt)
+        if data is None:
+            data = render(fmt)
+            self.put(key, fmt, data)
+        return data
+
+
+figure_cache = FigureCache(settings.FIGURE_CACHE_DIR, settings.FIGURE_CACHE_MAX_BYTES)
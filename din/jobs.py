@@ -0,0 +1,136 @@
+"""Job queue in the database for work too slow for a request.
+
+Jobs are queued with ``enqueue`` and run by ``python manage.py run_jobs``,
+any number of workers can share the queue. With ``JOBS_EAGER`` they run in
+the process that queues them instead, once its transaction is committed.
+"""
+import logging
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from din.db import retry_on_locked
+from din.models import Job, SessionSummary, Test, TestSession
+
+logger = logging.getLogger(__name__)
+
+
+def summarize_session(questionary: int, test: int) -> dict:
+    """Summarize a completed session and render its result figure."""
+    session = TestSession.objects.select_related("test").get(questionary_id=questionary, test_id=test)
+    summary = session.summarize()
+    return {"srt": summary.srt, "figure": render_result_figure(questionary, test)["figure"]}
+
+
+def summarize_test(test: int) -> dict:
+    """Recompute the summaries of all completed sessions of a test."""
+    from din.analytics import summarize_sessions
+
+    return {"summarized": summarize_sessions(Test.objects.filter(pk=test), force=True)}
+
+
+def render_result_figure(questionary: int, test: int, fmt: str = "png") -> dict:
+    from din.views import get_result_figure, render_result
+    from din.figures import figure_cache
+
+    summary = SessionSummary.objects.get(questionary_id=questionary, test_id=test)
+    figure = get_result_figure(summary, fmt)
+    figure_cache.get_or_render(figure["key"], fmt, lambda fmt: render_result(summary, fmt))
+    return {"srt": summary.srt, "figure": figure}
+
+
+def render_boxplot(active: bool = False, fmt: str = "png") -> dict:
+    from din.views import get_boxplot_data, get_boxplot_figure, get_boxplot_snr, get_overview_tests
+    from din.figures import figure_cache
+
+    labels, snr_data = get_boxplot_data(list(get_overview_tests(active)))
+    figure = get_boxplot_figure(labels, snr_data, active, fmt)
+    figure_cache.get_or_render(figure["key"], fmt, lambda fmt: get_boxplot_snr(labels, snr_data, fmt))
+    return {"figure": figure}
+
+
+HANDLERS = {
+    "summary": summarize_session,
+    "summarize_test": summarize_test,
+    "result_figure": render_result_figure,
+    "boxplot": render_boxplot,
+}
+
+
+@retry_on_locked
+def enqueue(kind: str, key: str, **args) -> Job:
+    """Queue a job, unless the job with this key is already pending or running.
+
+    A finished job is queued again, as its result was asked for anew.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job {kind}, choose from {list(HANDLERS)}")
+    job, created = Job.objects.get_or_create(key=key, defaults={"kind": kind, "args": args})
+    if not created and job.finished:
+        Job.objects.filter(pk=job.pk, status=job.status).update(
+            kind=kind, args=args, status=Job.PENDING, attempts=0, result=None, error="",
+            updated_at=timezone.now(),
+        )
+        job.refresh_from_db()
+
+    if settings.JOBS_EAGER and job.status == Job.PENDING:
+        transaction.on_commit(lambda: claim(job) and run_job(job))
+    return job
+
+
+def claim(job: Job) -> bool:
+    """Mark a job as running, if no other worker claimed it first."""
+    now = timezone.now()
+    claimed = Job.objects.filter(pk=job.pk, status=job.status, updated_at=job.updated_at).update(
+        status=Job.RUNNING, attempts=F("attempts") + 1, updated_at=now,
+    )
+    if claimed:
+        job.status, job.attempts, job.updated_at = Job.RUNNING, job.attempts + 1, now
+    return bool(claimed)
+
+
+def next_job(kinds=None):
+    """Claim the oldest pending job, or a running job whose worker was lost."""
+    lost = timezone.now() - timedelta(seconds=settings.JOBS_TIMEOUT)
+    jobs = Job.objects.filter(Q(status=Job.PENDING) | Q(status=Job.RUNNING, updated_at__lt=lost))
+    if kinds:
+        jobs = jobs.filter(kind__in=kinds)
+    for job in jobs.order_by("pk")[:10]:
+        if claim(job):
+            return job
+    return None
+
+
+@retry_on_locked
+def finish(job: Job, **fields):
+    Job.objects.filter(pk=job.pk).update(updated_at=timezone.now(), **fields)
+    for name, value in fields.items():
+        setattr(job, name, value)
+
+
+def run_job(job: Job) -> Job:
+    """Run a claimed job, failed jobs are queued again up to ``JOBS_MAX_ATTEMPTS`` times."""
+    start = time.perf_counter()
+    try:
+        result = HANDLERS[job.kind](**job.args)
+    except Exception:
+        logger.exception("job %s failed, attempt %d", job.key, job.attempts)
+        status = Job.PENDING if job.attempts < settings.JOBS_MAX_ATTEMPTS else Job.FAILED
+        finish(job, status=status, error=traceback.format_exc())
+    else:
+        finish(job, status=Job.DONE, result=result, error="")
+        logger.info("job %s done in %.3f s", job.key, time.perf_counter() - start)
+    return job
+
+
+def purge(days: float = None) -> int:
+    """Delete the jobs finished more than ``days`` ago."""
+    days = settings.JOBS_KEEP_DAYS if days is None else days
+    before = timezone.now() - timedelta(days=days)
+    deleted, _ = Job.objects.filter(status__in=(Job.DONE, Job.FAILED), updated_at__lt=before).delete()
+    return deleted
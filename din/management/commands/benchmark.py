@@ -0,0 +1,280 @@
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import matplotlib.pyplot as plt
+from scipy.special import expit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from din.models import Test, Stimulus, Questionary, Response, SessionSummary
+from din.utils import (
+    get_bins,
+    get_bins_batch,
+    get_srt,
+    fit_curve,
+    fit_psychometric_batch,
+    get_plots,
+    DIGIT_RANDOM_LVL,
+)
+from din.analytics import load_sessions
+from din.views import plot_to_data
+
+DIGITS = np.array(list("0123456789"))
+
+
+def simulate_sessions(test, n_sessions, rng):
+    """Staircase sessions of listeners with srts drawn around -8 dB.
+
+    Returns the levels, number of correct digits and srt per session as
+    arrays of shape (n_sessions, n_questions) and (n_sessions, ).
+    """
+    srt = rng.normal(-8, 2, n_sessions)
+    levels = np.empty((n_sessions, test.n_questions), dtype=np.int64)
+    n_correct = np.empty_like(levels)
+    level = np.full(n_sessions, test.starting_level)
+    for i in range(test.n_questions):
+        p_digit = np.maximum(expit((level - srt) / 1.5) ** (1 / 3), 0.1)
+        levels[:, i] = level
+        n_correct[:, i] = rng.binomial(3, p_digit)
+        level = np.where(
+            n_correct[:, i] == 3,
+            np.maximum(level - test.increment, test.min_level),
+            np.minimum(level + test.increment, test.max_level),
+        )
+    srts = np.array([get_srt(lv.tolist(), nx) for lv, nx in zip(levels, level)])
+    return levels, n_correct, srts
+
+
+class Dataset:
+    """A synthetic test with ``n_sessions`` completed sessions in the database."""
+
+    def __init__(self, n_sessions, seed=0, batch_size=10_000):
+        rng = np.random.default_rng(seed)
+        self.test = Test.objects.create(name=f"bench{n_sessions}", active=True)
+        test = self.test
+        labels = ["".join(x) for x in rng.choice(DIGITS, (test.n_stimuli // 4, 3))]
+        Stimulus.objects.bulk_create([
+            Stimulus(name=f"{label}.wav", test=test, level=level, label=label)
+            for level in range(test.min_level, test.max_level + 1, test.increment)
+            for label in labels
+        ])
+        stimuli = {(s.level, s.label): s.pk for s in test.stimulus_set.all()}
+
+        self.levels, self.n_correct, self.srt = simulate_sessions(test, n_sessions, rng)
+        questionaries = Questionary.objects.bulk_create([
+            Questionary(age=30, normal_hearing=True, approve=True, first_time=True, first_language=True)
+            for _ in range(n_sessions)
+        ], batch_size=batch_size)
+        self.questionary_ids = [q.pk for q in questionaries]
+
+        responses = []
+        for qid, levels, n_correct in zip(self.questionary_ids, self.levels, self.n_correct):
+            for index, (level, n) in enumerate(zip(levels.tolist(), n_correct.tolist()), 1):
+                label = labels[rng.integers(len(labels))]
+                answer = label[:n] + "".join(str((int(c) + 1) % 10) for c in label[n:])
+                responses.append(Response(
+                    index=index, questionary_id=qid, test=test,
+                    stimulus_id=stimuli[level, label], answer=answer,
+                ))
+            if len(responses) >= batch_size:
+                Response.objects.bulk_create(responses)
+                responses = []
+        Response.objects.bulk_create(responses)
+
+        SessionSummary.objects.bulk_create([
+            SessionSummary(
+                questionary_id=qid, test=test, srt=srt,
+                levels=levels.tolist(), n_correct=n_correct.tolist(),
+            )
+            for qid, levels, n_correct, srt in zip(
+                self.questionary_ids, self.levels, self.n_correct, self.srt.tolist())
+        ], batch_size=batch_size)
+
+
+def get_bins_all(data):
+    for levels, n_correct in zip(data.levels, data.n_correct):
+        get_bins(levels, n_correct)
+    return len(data.levels)
+
+
+def get_bins_batch_all(data):
+    get_bins_batch(data.levels, data.n_correct)
+    return 1
+
+
+def fit_curve_sample(data, sample):
+    for levels, n_correct in zip(data.levels[:sample], data.n_correct[:sample]):
+        bins, _, bin_words_correct, trials = get_bins(levels, n_correct)
+        try:
+            fit_curve(bins, bin_words_correct, trials * 3, DIGIT_RANDOM_LVL)
+        except (RuntimeError, ValueError):
+            pass
+    return min(sample, len(data.levels))
+
+
+def fit_psychometric_batch_all(data):
+    fit_psychometric_batch(data.levels, data.n_correct)
+    return 1
+
+
+def get_plots_sample(data, sample):
+    for levels, n_correct, srt in zip(data.levels[:sample], data.n_correct[:sample], data.srt):
+        plt.close(get_plots(levels, n_correct, srt))
+    return min(sample, len(data.levels))
+
+
+def plot_to_data_sample(data, sample):
+    figures = [
+        get_plots(levels, n_correct, srt)
+        for levels, n_correct, srt in zip(data.levels[:sample], data.n_correct[:sample], data.srt)
+    ]
+    start = time.perf_counter()
+    for fig in figures:
+        plot_to_data(fig)
+    return len(figures), time.perf_counter() - start
+
+
+def get_snrs(data):
+    data.test.get_snrs()
+    return 1
+
+
+def n_correct_sample(data, sample):
+    responses = Response.objects.filter(
+        questionary__in=data.questionary_ids[:sample]).select_related("stimulus")
+    return len([response.n_correct for response in responses])
+
+
+def load_sessions_all(data):
+    load_sessions(Test.objects.filter(pk=data.test.pk))
+    return 1
+
+
+class Command(BaseCommand):
+    help = "Benchmark the analytics and rendering hot paths on synthetic sessions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1_000, 10_000],
+                            help="number of synthetic sessions per dataset")
+        parser.add_argument('--sample', type=int, default=200,
+                            help="sessions used for the per session fits and n_correct")
+        parser.add_argument('--plots', type=int, default=5, help="sessions to render figures for")
+        parser.add_argument('--repeat', type=int, default=3, help="timing runs, the fastest is kept")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', type=str, default=None, help="write the results to this json file")
+        parser.add_argument('--baseline', type=str, default=None, help="json file of an earlier run to compare with")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="relative slowdown or memory growth reported as a regression")
+
+    def measure(self, func, data, repeat):
+        """Fastest wall time, peak traced memory and queries of ``func(data)``.
+
+        A benchmark returns its number of calls, or (calls, seconds) when only
+        part of its work should be timed.
+        """
+        times = []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                result = func(data)
+                elapsed = time.perf_counter() - start
+            if isinstance(result, tuple):
+                result, elapsed = result
+            times.append(elapsed)
+
+        tracemalloc.start()
+        func(data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            "time_s": min(times),
+            "per_call_s": min(times) / max(result, 1),
+            "calls": result,
+            "peak_mb": peak / 2 ** 20,
+            "queries": len(ctx),
+        }
+
+    def handle(self, *args, **options):
+        sample, plots = options['sample'], options['plots']
+        benchmarks = {
+            "get_bins": get_bins_all,
+            "get_bins_batch": get_bins_batch_all,
+            "fit_curve": lambda data: fit_curve_sample(data, sample),
+            "fit_psychometric_batch": fit_psychometric_batch_all,
+            "get_plots": lambda data: get_plots_sample(data, plots),
+            "plot_to_data": lambda data: plot_to_data_sample(data, plots),
+            "get_snrs": get_snrs,
+            "n_correct": lambda data: n_correct_sample(data, sample),
+            "load_sessions": load_sessions_all,
+        }
+
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "benchmark.sqlite3")
+            old_name = connection.creation.create_test_db(verbosity=0)
+            try:
+                for size in options['sizes']:
+                    start = time.perf_counter()
+                    data = Dataset(size, options['seed'])
+                    self.stdout.write(f"created {size} sessions in {time.perf_counter() - start:.1f} s")
+                    for name, func in benchmarks.items():
+                        results[f"{name}[{size}]"] = self.measure(func, data, options['repeat'])
+                        self.print_result(f"{name}[{size}]", results[f"{name}[{size}]"])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            "meta": {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+            },
+            "results": results,
+        }
+        if options['output']:
+            with open(options['output'], "w") as f:
+                json.dump(report, f, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)["results"]
+            regressions = self.compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError(f"{len(regressions)} regressions: {', '.join(regressions)}")
+
+    def print_result(self, name, result):
+        self.stdout.write(
+            f"{name:<32}{result['time_s'] * 1000:>10.1f} ms{result['per_call_s'] * 1000:>10.3f} ms/call"
+            f"{result['peak_mb']:>9.1f} MB{result['queries']:>6} queries"
+        )
+
+    def compare(self, results, baseline, tolerance):
+        self.stdout.write(f"{'benchmark':<32}{'time':>8}{'memory':>8}{'queries':>9}")
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            base = baseline[name]
+            time_ratio = result["per_call_s"] / max(base["per_call_s"], 1e-9)
+            memory_ratio = result["peak_mb"] / max(base["peak_mb"], 1e-3)
+            regressed = (
+                time_ratio > 1 + tolerance
+                or memory_ratio > 1 + tolerance
+                or result["queries"] > base["queries"]
+            )
+            if regressed:
+                regressions.append(name)
+            self.stdout.write(
+                f"{name:<32}{time_ratio:>7.2f}x{memory_ratio:>7.2f}x"
+                f"{result['queries'] - base['queries']:>+9}{'  REGRESSION' if regressed else ''}"
+            )
+        return regressions
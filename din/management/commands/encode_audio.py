@@ -0,0 +1,87 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import soundfile as sf
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from din.models import Test, AUDIO_FORMATS
+# the level computation of the rescaler, so the check measures what it set
+from scripts.rescale_sound import rms_db
+
+# soundfile format, subtype and sample rate per encoded format, None keeps the rate
+ENCODINGS = {
+    "opus": ("OGG", "OPUS", 48000),
+    "mp3": ("MP3", None, None),
+    "flac": ("FLAC", "PCM_16", None),
+}
+
+
+def encode(path, fmt):
+    """Encode a wav file next to itself and return the level change in dB.
+
+    The level of the decoded file is compared to the source wav, so a level
+    change by resampling is caught as well.
+    """
+    import soxr
+
+    source, sr = sf.read(path)
+    y = source
+    fmt_name, subtype, rate = ENCODINGS[fmt]
+    if rate is not None and rate != sr:
+        y, sr = soxr.resample(source, sr, rate), rate
+
+    target = f"{os.path.splitext(path)[0]}.{AUDIO_FORMATS[fmt][0]}"
+    sf.write(target, y, sr, format=fmt_name, subtype=subtype)
+    decoded, _ = sf.read(target)
+    return target, rms_db(decoded) - rms_db(source)
+
+
+class Command(BaseCommand):
+    help = "Encode the wav stimuli of a data set into compressed formats and check their levels"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', type=str)
+        parser.add_argument('--formats', nargs='+', default=list(ENCODINGS), choices=list(ENCODINGS))
+        parser.add_argument('--tolerance', type=float, default=0.25, help="max level change in dB")
+        parser.add_argument('--jobs', type=int, default=os.cpu_count())
+
+    def handle(self, *args, **options):
+        data_set = settings.MEDIA_ROOT / options['name']
+        if not data_set.is_dir():
+            self.stderr.write(f"{options['name']} not found")
+            return
+
+        files = sorted(data_set.glob("snr*/*.wav"))
+        failed = {fmt: [] for fmt in options['formats']}
+        with ProcessPoolExecutor(options['jobs']) as pool:
+            jobs = [
+                (fmt, path, pool.submit(encode, str(path), fmt))
+                for fmt in options['formats'] for path in files
+            ]
+            for fmt, path, job in jobs:
+                try:
+                    target, delta = job.result()
+                except Exception as err:
+                    failed[fmt].append(path)
+                    self.stderr.write(f"FAILED {path} ({fmt}): {err}")
+                    continue
+                if abs(delta) > options['tolerance']:
+                    failed[fmt].append(path)
+                    os.remove(target)
+                    self.stderr.write(f"FAILED {target}: level changed by {delta:.2f} dB")
+
+        formats = [fmt for fmt in options['formats'] if len(failed[fmt]) == 0]
+        for fmt in options['formats']:
+            self.stdout.write(f"{fmt} {len(files) - len(failed[fmt])} encoded, {len(failed[fmt])} failed")
+
+        tests = [
+            test for test in Test.objects.all() 
+            if f"{test.name}_{test.audio_generator}" == options['name']
+        ]
+        for test in tests:
+            available = (set(test.formats) - set(failed)) | set(formats)
+            test.audio_formats = ",".join(fmt for fmt in AUDIO_FORMATS if fmt in available)
+            test.save(update_fields=["audio_formats"])
+            self.stdout.write(f"{test.pk} serving {test.audio_formats}")
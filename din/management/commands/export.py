@@ -0,0 +1,55 @@
+import argparse
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from din.export import EXPORTS, WRITERS, get_date, iter_export
+
+
+def date_argument(value: str):
+    try:
+        return get_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date {value!r}, use YYYY-MM-DD")
+
+
+class Command(BaseCommand):
+    help = "Stream raw responses or session summaries to a csv or parquet file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(EXPORTS))
+        parser.add_argument('--format', choices=list(WRITERS), default="csv")
+        parser.add_argument('--output', type=str, default=None, help="file to write to, csv defaults to stdout")
+        parser.add_argument('--test', type=int, nargs='+', default=None, help="only these test ids")
+        parser.add_argument('--active', choices=["yes", "no"], default=None, help="only (in)active tests")
+        parser.add_argument('--start', type=date_argument, default=None, help="sessions completed on or after (YYYY-MM-DD)")
+        parser.add_argument('--end', type=date_argument, default=None, help="sessions completed on or before (YYYY-MM-DD)")
+        parser.add_argument('--chunk_size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        if options['output'] is None and options['format'] != "csv":
+            raise CommandError(f"--output is required for {options['format']} exports")
+
+        try:
+            chunks = iter_export(
+                options['kind'],
+                options['format'],
+                options['chunk_size'],
+                tests=options['test'],
+                active=None if options['active'] is None else options['active'] == "yes",
+                start=options['start'],
+                end=options['end'],
+            )
+        except ImportError as err:
+            raise CommandError(err)
+        if options['output'] is None:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            return
+
+        n_bytes = 0
+        with open(options['output'], "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                n_bytes += len(chunk)
+        self.stdout.write(f"wrote {n_bytes} bytes to {options['output']}")
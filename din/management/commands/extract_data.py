@@ -1,4 +1,12 @@
+import contextlib
+import hashlib
+import inspect
+import io
 import itertools
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
@@ -9,12 +17,48 @@ from scipy import stats
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connections
 
-from din.models import Test, Response
+from din.models import Test
+from din.analytics import load_sessions
+from din.resampling import compare_groups
 
 COLORS = ['#0072B2', '#CC79A7', '#009E73']
 LABELS = ["Unprocessed", "NH Vocoded", "EH Vocoded"]
 
+# step name: (method, files it writes to MEDIA_ROOT)
+STEPS = {
+    "boxplot": ("make_boxplot", ["boxplot_din.png"]),
+    "age_scatter": ("make_age_scatter_plot", ["ageplot_din.png"]),
+    "comparison": ("make_comparison_plot", ["comparison_plot.png"]),
+    "vs_studies": ("vs_studies", []),
+    "pairwise": ("pairwise", []),
+    "resampling": ("resampling", []),
+}
+# the code of the steps, including the helpers and constants they use
+STEP_MODULES = (__name__, compare_groups.__module__)
+
+
+def get_step_key(step: str, result: pd.DataFrame, dpi: int) -> str:
+    """Hash of the input data, the step, the source of the report code and the figure resolution."""
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(result, index=True).values.tobytes())
+    digest.update(json.dumps([step, list(result.columns), dpi]).encode())
+    for module in STEP_MODULES:
+        digest.update(inspect.getsource(sys.modules[module]).encode())
+    return digest.hexdigest()[:32]
+
+
+def run_step(step: str, result: pd.DataFrame, dpi: int) -> str:
+    """Run a step, in a worker process, and return what it printed."""
+    command = Command()
+    command.dpi = dpi
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        getattr(command, STEPS[step][0])(result)
+    plt.close("all")
+    return output.getvalue()
+
 def tost_from_summary(mean1, std1, nobs1, mean2, std2, nobs2, 
                       delta=1, alpha=0.05, equal_var=False):
     # Lower bound test: mean1 > mean2 - delta
@@ -38,7 +82,15 @@ def tost_from_summary(mean1, std1, nobs1, mean2, std2, nobs2,
     }
 
 class Command(BaseCommand):
-    help = "Describe what this command does"
+    help = "Compute the SRTs of completed participants, write results.csv and run the report steps"
+    dpi = 600
+
+    def add_arguments(self, parser):
+        parser.add_argument('--steps', nargs='+', choices=[*STEPS, "all"], default=["vs_studies"],
+                            help="report steps to run")
+        parser.add_argument('--jobs', type=int, default=1, help="run the steps in this many processes")
+        parser.add_argument('--dpi', type=int, default=600, help="resolution of the saved figures")
+        parser.add_argument('--force', action='store_true', help="rerun steps whose inputs did not change")
 
     def make_boxplot(self, result: pd.DataFrame):
         groups = result['test'].unique()
@@ -101,7 +153,7 @@ class Command(BaseCommand):
         ax.tick_params(axis='both', which='major', labelsize=14)
         ax.set_ylabel("SRT [dB]", fontsize=15)
         plt.tight_layout()
-        plt.savefig(settings.MEDIA_ROOT / "boxplot_din.png", dpi=600)        
+        plt.savefig(settings.MEDIA_ROOT / "boxplot_din.png", dpi=self.dpi)        
 
     def make_age_scatter_plot(self, result: pd.DataFrame):
         fig, ax = plt.subplots(figsize=(7, 4))
@@ -125,7 +177,7 @@ class Command(BaseCommand):
         ax.set_xlabel("Age", fontsize=15)
         ax.tick_params(axis='both', which='major', labelsize=14)
         plt.tight_layout()
-        plt.savefig(settings.MEDIA_ROOT / "ageplot_din.png", dpi=600)    
+        plt.savefig(settings.MEDIA_ROOT / "ageplot_din.png", dpi=self.dpi)    
 
         
         model = smf.ols('srt ~ age', data=result).fit()
@@ -148,7 +200,7 @@ class Command(BaseCommand):
         ax.tick_params(axis='both', which='major', labelsize=14)
 
         plt.tight_layout()
-        plt.savefig(settings.MEDIA_ROOT / "comparison_plot.png", dpi=600)    
+        plt.savefig(settings.MEDIA_ROOT / "comparison_plot.png", dpi=self.dpi)    
 
     def vs_studies(self, result: pd.DataFrame):
         
@@ -204,26 +256,26 @@ class Command(BaseCommand):
                                             equal_var=False)
             print(x, y, t, p, abs(mean1 - mean2))
 
+    def resampling(self, result, n_resamples=10_000, seed=0):
+        """Bootstrap CIs, TOST within 1 dB and Holm corrected permutation p-values of all pairs."""
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            for paired in (False, True):
+                print(compare_groups(
+                    result["srt"], result["test"], result["pk"], paired=paired,
+                    n_resamples=n_resamples, seed=seed,
+                ).round(4))
+
 
 
     def handle(self, *args, **options):
-        tests = Test.objects.filter(active=True)
-        result = []
-        for test in tests:
-            for responses in test.iter_entries(True):
-                levels = np.array([x.stimulus.level for x in responses])
-                snr_levels = np.r_[
-                    levels[-20:], Response.get_next_level(responses.last())
-                ]
-                questionary = responses[0].questionary
-                result.append((
-                    test.audio_generator,   
-                    questionary.pk,
-                    questionary.age,
-                    questionary.first_time,
-                    np.mean(snr_levels)
-                ))
-        result = pd.DataFrame(result, columns=["test", "pk", "age", "first_time", "srt"])
+        _, sessions = load_sessions(Test.objects.filter(active=True))
+        result = pd.DataFrame({
+            "test": sessions["audio_generator"],
+            "pk": sessions["questionary"],
+            "age": sessions["age"],
+            "first_time": sessions["first_time"],
+            "srt": sessions["srt"],
+        })
         m = result.groupby(["pk"])['test'].count() != 3
         not_completed = m[m].index.values
         deaf_people = result[(result['srt'] > -6.0) & (result['test'] == 'calibrated')]['pk'].values
@@ -232,8 +284,38 @@ class Command(BaseCommand):
         print(result[result['pk'].isin(drop_pk)])
         result = result[~result['pk'].isin(drop_pk)]
         result.to_csv(settings.MEDIA_ROOT / "results.csv", index=False)
-        self.vs_studies(result)
-        # self.pairwise(result)
-        # self.make_boxplot(result)
-        # self.make_age_scatter_plot(result)
-        # self.make_comparison_plot(result) 
+        result = result.reset_index(drop=True)
+
+        steps = list(STEPS) if "all" in options['steps'] else list(dict.fromkeys(options['steps']))
+        self.run_steps(steps, result, options['dpi'], options['jobs'], options['force'])
+
+    def run_steps(self, steps, result, dpi, jobs, force):
+        """Run the steps in a process pool, skipping those cached for the same input.
+
+        The printed output of a step is cached with its key next to the figures
+        it wrote, both are reused as long as the key matches and the files exist.
+        """
+        cache_dir = Path(settings.REPORT_CACHE_DIR)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        keys = {step: get_step_key(step, result, dpi) for step in steps}
+        outputs = {}
+        for step in steps:
+            cached = cache_dir / f"{step}-{keys[step]}.txt"
+            files = [settings.MEDIA_ROOT / name for name in STEPS[step][1]]
+            if not force and cached.exists() and all(path.exists() for path in files):
+                outputs[step] = cached.read_text()
+
+        todo = [step for step in steps if step not in outputs]
+        # workers only get the DataFrame, close the connections instead of forking them
+        connections.close_all()
+        with ProcessPoolExecutor(max(1, min(jobs, len(todo) or 1))) as pool:
+            futures = {step: pool.submit(run_step, step, result, dpi) for step in todo}
+            for step, future in futures.items():
+                outputs[step] = future.result()
+                for old in cache_dir.glob(f"{step}-*.txt"):
+                    old.unlink()
+                (cache_dir / f"{step}-{keys[step]}.txt").write_text(outputs[step])
+
+        for step in steps:
+            self.stdout.write(f"== {step}{'' if step in todo else ' (cached)'}")
+            self.stdout.write(outputs[step], ending="")
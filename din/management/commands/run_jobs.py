@@ -0,0 +1,54 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from din import jobs
+
+
+class Command(BaseCommand):
+    help = "Run the queued background jobs (session summaries and figures)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="exit when the queue is empty")
+        parser.add_argument('--kind', type=str, nargs='*', choices=list(jobs.HANDLERS), default=None,
+                            help="only run jobs of these kinds")
+        parser.add_argument('--poll', type=float, default=1.0, help="seconds between polls of an empty queue")
+        parser.add_argument('--max_jobs', type=int, default=None, help="exit after running this many jobs")
+        parser.add_argument('--purge_interval', type=float, default=3600,
+                            help="seconds between deleting old finished jobs")
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+
+        n_jobs, last_purge = 0, 0.0
+        while not self.stopping:
+            if time.monotonic() - last_purge > options['purge_interval']:
+                last_purge = time.monotonic()
+                deleted = jobs.purge()
+                if deleted:
+                    self.stdout.write(f"purged {deleted} finished jobs")
+
+            close_old_connections()
+            job = jobs.next_job(options['kind'])
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['poll'])
+                continue
+
+            start = time.perf_counter()
+            jobs.run_job(job)
+            n_jobs += 1
+            self.stdout.write(f"{job.key}: {job.status} in {time.perf_counter() - start:.3f} s")
+            if options['max_jobs'] is not None and n_jobs >= options['max_jobs']:
+                break
+
+        self.stdout.write(f"ran {n_jobs} jobs")
+
+    def stop(self, signum, frame):
+        # finish the running job, then exit
+        self.stopping = True
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+from scipy.special import expit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from django.test import Client, AsyncClient
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, Resolver404
+
+from din.db import LOCKED_HEADER, is_locked
+from din.models import Test, Stimulus, SessionSummary
+
+SOURCE_RE = re.compile(r'<source src="([^"]+)"')
+STIMULUS_RE = re.compile(r"/snr([+-]\d+)/(\w+)\.\w+")
+
+
+def url_name(path):
+    try:
+        return resolve(urlsplit(path).path).url_name
+    except Resolver404:
+        return "unknown"
+
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock_errors = 0
+        self.completed = 0
+
+    def report(self, duration):
+        n_requests = sum(len(x) for x in self.latency.values())
+        views = {}
+        for name, latency in sorted(self.latency.items()):
+            latency = np.array(latency) * 1000
+            queries = self.queries.get(name)
+            views[name] = {
+                "requests": len(latency),
+                "mean_ms": float(latency.mean()),
+                "p50_ms": float(np.percentile(latency, 50)),
+                "p95_ms": float(np.percentile(latency, 95)),
+                "p99_ms": float(np.percentile(latency, 99)),
+                "max_ms": float(latency.max()),
+                "queries": float(np.mean(queries)) if queries else None,
+                "errors": self.errors.get(name, 0),
+            }
+        return {
+            "duration_s": duration,
+            "requests": n_requests,
+            "requests_per_s": n_requests / duration,
+            "participants_completed": self.completed,
+            "errors": sum(self.errors.values()),
+            "lock_errors": self.lock_errors,
+            "views": views,
+        }
+
+
+class WsgiTransport:
+    """Requests the in-process WSGI app, counting the queries of each request."""
+
+    def __init__(self):
+        self.client = Client()
+
+    def _request(self, method, path, data):
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            response = getattr(self.client, method)(path, data)
+            latency = time.perf_counter() - start
+        body = b"" if response.streaming else response.content
+        return response.status_code, response.headers, body.decode(), latency, len(ctx)
+
+    async def request(self, method, path, data=None):
+        return await asyncio.to_thread(self._request, method, path, data)
+
+
+class AsgiTransport:
+    """Requests the in-process ASGI app from the event loop."""
+
+    def __init__(self):
+        self.client = AsyncClient()
+
+    async def request(self, method, path, data=None):
+        start = time.perf_counter()
+        response = await getattr(self.client, method)(path, data)
+        latency = time.perf_counter() - start
+        return response.status_code, response.headers, response.content.decode(), latency, None
+
+
+class HttpTransport:
+    """Requests a running server over HTTP."""
+
+    def __init__(self, base_url):
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def _request(self, method, path, data):
+        if method == "post":
+            data = {**(data or {}), "csrfmiddlewaretoken": self.session.cookies.get("csrftoken", "")}
+        start = time.perf_counter()
+        response = self.session.request(
+            method, self.base_url + path, data=data, allow_redirects=False,
+            headers={"Referer": self.base_url + path},
+        )
+        latency = time.perf_counter() - start
+        return response.status_code, response.headers, response.text, latency, None
+
+    async def request(self, method, path, data=None):
+        return await asyncio.to_thread(self._request, method, path, data)
+
+
+class Participant:
+    """A virtual participant answering according to a psychometric function.
+
+    The probability to get a whole triplet right is a logistic around the
+    participant's srt; digits are answered independently. A replayed session
+    instead gets exactly the recorded number of digits right per question.
+    """
+
+    def __init__(self, transport, stats, srt, slope=1.5, replay=None, api=False, think_time=0.0):
+        self.transport = transport
+        self.stats = stats
+        self.srt = srt
+        self.slope = slope
+        self.replay = replay or {}
+        self.api = api
+        self.think_time = think_time
+
+    async def request(self, method, path, data=None):
+        name = url_name(path)
+        if self.think_time:
+            await asyncio.sleep(random.expovariate(1 / self.think_time))
+        try:
+            status, headers, body, latency, n_queries = await self.transport.request(method, path, data)
+        except OperationalError as err:
+            # raised outside the views, before DatabaseLockedMiddleware sees it
+            self.stats.errors[name] += 1
+            self.stats.lock_errors += is_locked(err)
+            raise
+        self.stats.latency[name].append(latency)
+        if n_queries is not None:
+            self.stats.queries[name].append(n_queries)
+        if status >= 400:
+            self.stats.errors[name] += 1
+            self.stats.lock_errors += LOCKED_HEADER in headers
+            raise RuntimeError(f"{method.upper()} {path} returned {status}")
+        return headers.get("Location"), body
+
+    def answer(self, tid, index, level, label):
+        recorded = self.replay.get(tid)
+        if recorded is not None and index <= len(recorded):
+            n_correct = recorded[index - 1]
+        else:
+            p_triplet = expit((level - self.srt) / self.slope)
+            p_digit = max(p_triplet ** (1 / 3), 0.1)
+            n_correct = sum(random.random() < p_digit for _ in label)
+        right = set(random.sample(range(len(label)), n_correct))
+        return "".join(
+            c if i in right else random.choice([d for d in "0123456789" if d != c])
+            for i, c in enumerate(label)
+        )
+
+    async def run(self):
+        await self.request("get", "/questionary")
+        location, _ = await self.request("post", "/questionary", {
+            "age": random.randint(18, 80),
+            "first_time": "on",
+            "normal_hearing": "on",
+            "first_language": "on",
+            "approve": "on",
+        })
+        await self.request("get", location)
+        qid = int(location.strip("/").split("/")[-1])
+        await self.request("get", f"/test_question/{qid}/")
+        location, _ = await self.request("post", f"/test_question/{qid}/")
+
+        if self.api:
+            await self.run_api(location)
+        else:
+            while url_name(location) == "question":
+                _, body = await self.request("get", location)
+                level, label = STIMULUS_RE.search(SOURCE_RE.search(body).group(1)).groups()
+                _, _, tid, index = location.strip("/").split("/")
+                answer = self.answer(int(tid), int(index), int(level), label)
+                location, _ = await self.request("post", location, {"answer": answer})
+            await self.request("get", location)
+        self.stats.completed += 1
+
+    async def run_api(self, location):
+        _, body = await self.request("get", location.replace("/question/", "/api/question/"))
+        question = json.loads(body)
+        while True:
+            level, label = STIMULUS_RE.search(question["sources"][0][0]).groups()
+            tid = int(question["url"].strip("/").split("/")[2])
+            answer = self.answer(tid, question["current"], int(level), label)
+            _, body = await self.request("post", question["api_url"], {"answer": answer})
+            result = json.loads(body)
+            if result["next"] is None:
+                await self.request("get", result["complete_url"])
+                return
+            question = result["next"]
+
+
+class Command(BaseCommand):
+    help = "Simulate concurrent participants running the DIN test and report latencies"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, default=20)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--target', choices=["wsgi", "asgi", "http"], default="wsgi")
+        parser.add_argument('--url', type=str, default="http://127.0.0.1:8000", help="server for --target http")
+        parser.add_argument('--api', action='store_true', help="answer through the JSON api")
+        parser.add_argument('--replay', action='store_true', help="replay recorded sessions from the database")
+        parser.add_argument('--srt_mean', type=float, default=-8.0)
+        parser.add_argument('--srt_std', type=float, default=2.0)
+        parser.add_argument('--think_time', type=float, default=0.0, help="mean seconds between requests")
+        parser.add_argument('--in_place', action='store_true', 
+                            help="run in-process targets against the configured database instead of a copy")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', type=str, default=None, help="write the report to this file")
+
+    def get_replays(self, n):
+        sessions = defaultdict(dict)
+        summaries = SessionSummary.objects.filter(test__active=True).values_list(
+            "questionary", "test", "n_correct")
+        for questionary_id, test_id, n_correct in summaries:
+            sessions[questionary_id][test_id] = n_correct
+        sessions = list(sessions.values())
+        if len(sessions) == 0:
+            return [None] * n
+        return [sessions[i % len(sessions)] for i in range(n)]
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        # failed requests are counted in the report, not logged one by one
+        logging.getLogger("django.request").setLevel(logging.CRITICAL)
+        n = options['participants']
+        replays = self.get_replays(n) if options['replay'] else [None] * n
+
+        in_process = options['target'] != "http"
+        if in_process:
+            settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "testserver"]
+        with tempfile.TemporaryDirectory() as directory:
+            old_name = None
+            if in_process and not options['in_place']:
+                tests = list(Test.objects.filter(active=True))
+                stimuli = list(Stimulus.objects.filter(test__in=tests))
+                connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "simulate_load.sqlite3")
+                old_name = connection.creation.create_test_db(verbosity=0)
+                Test.objects.bulk_create(tests)
+                Stimulus.objects.bulk_create(stimuli)
+
+            try:
+                if not Test.objects.filter(active=True).exists() and in_process:
+                    self.stdout.write("no active tests to run")
+                    return
+                report = asyncio.run(self.simulate(options, replays))
+            finally:
+                if old_name is not None:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.print_report(report)
+        if options['json']:
+            with open(options['json'], "w") as f:
+                json.dump(report, f, indent=2)
+
+    async def simulate(self, options, replays):
+        stats = Stats()
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(options['concurrency']))
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        def transport():
+            if options['target'] == "wsgi":
+                return WsgiTransport()
+            if options['target'] == "asgi":
+                return AsgiTransport()
+            return HttpTransport(options['url'])
+
+        async def run(replay):
+            participant = Participant(
+                transport(), stats, random.gauss(options['srt_mean'], options['srt_std']),
+                replay=replay, api=options['api'], think_time=options['think_time'],
+            )
+            async with semaphore:
+                try:
+                    await participant.run()
+                except Exception as err:
+                    self.stderr.write(f"participant failed: {err}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run(replay) for replay in replays))
+        return stats.report(time.perf_counter() - start)
+
+    def print_report(self, report):
+        self.stdout.write(f"{'view':<24}{'n':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'queries':>9}{'errors':>8}")
+        for name, view in report["views"].items():
+            queries = "-" if view["queries"] is None else f"{view['queries']:.1f}"
+            self.stdout.write(
+                f"{name:<24}{view['requests']:>7}{view['mean_ms']:>9.1f}{view['p50_ms']:>9.1f}"
+                f"{view['p95_ms']:>9.1f}{view['p99_ms']:>9.1f}{view['max_ms']:>9.1f}"
+                f"{queries:>9}{view['errors']:>8}"
+            )
+        self.stdout.write(
+            f"{report['participants_completed']} participants in {report['duration_s']:.1f} s, "
+            f"{report['requests_per_s']:.1f} requests/s, {report['errors']} errors "
+            f"({report['lock_errors']} database locked)"
+        )
@@ -0,0 +1,171 @@
+import itertools
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from din.models import Test, SessionSummary
+from din.snapshot import (
+    SESSION_COLUMNS,
+    SNAPSHOT_VERSION,
+    TRIAL_COLUMNS,
+    read_meta,
+    write_meta,
+    append_table,
+    drop_rows,
+    update_table,
+)
+
+FIELDS = (
+    "pk",
+    "updated_at",
+    "completed_at",
+    "questionary_id",
+    "test_id",
+    "srt",
+    "digit_x50",
+    "triplet_x50",
+    "questionary__age",
+    "questionary__first_time",
+    "questionary__normal_hearing",
+    "questionary__first_language",
+    "levels",
+    "n_correct",
+)
+
+
+def get_pks(path: Path, meta: dict) -> np.ndarray:
+    """The pk of every session in the snapshot, in row order."""
+    if meta["n_sessions"] == 0:
+        return np.array([], dtype=np.int64)
+    return np.load(path / "sessions" / "pk.npy", mmap_mode="r")[:meta["n_sessions"]]
+
+
+def is_complete(path: Path, meta: dict) -> bool:
+    """Whether every column holds the rows counted in the meta, an interrupted run may leave fewer."""
+    for table, columns, n_rows in (
+        ("sessions", SESSION_COLUMNS, meta["n_sessions"]),
+        ("trials", TRIAL_COLUMNS, meta["n_trials"]),
+    ):
+        for name in columns if n_rows else ():
+            try:
+                if len(np.load(path / table / f"{name}.npy", mmap_mode="r")) < n_rows:
+                    return False
+            except (FileNotFoundError, ValueError):
+                return False
+    return True
+
+
+class Command(BaseCommand):
+    help = "Update the memory-mappable analysis snapshot with the sessions summarized since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, default=str(settings.SNAPSHOT_DIR))
+        parser.add_argument('--rebuild', action='store_true', help="start over instead of updating")
+        parser.add_argument('--database', type=str, default="default", help="database alias to read from, e.g. a replica")
+        parser.add_argument('--chunk_size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        path.mkdir(parents=True, exist_ok=True)
+        meta = read_meta(path)
+        if options['rebuild'] or meta["version"] != SNAPSHOT_VERSION or not is_complete(path, meta):
+            meta.update(version=SNAPSHOT_VERSION, n_sessions=0, n_trials=0, watermark=None)
+
+        # recomputed summaries get a new updated_at, so they are read again
+        summaries = SessionSummary.objects.using(options['database'])
+        watermark = meta["watermark"]
+        if watermark is not None:
+            updated_at = datetime.fromisoformat(watermark["updated_at"])
+            summaries = summaries.filter(
+                Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, pk__gt=watermark["pk"])
+            )
+        rows = summaries.order_by("updated_at", "pk").values_list(*FIELDS).iterator(
+            chunk_size=options['chunk_size'])
+
+        meta["tests"] = {
+            str(test.pk): {
+                "name": test.name,
+                "audio_generator": test.audio_generator,
+                "active": test.active,
+                "n_questions": test.n_questions,
+            }
+            for test in Test.objects.using(options['database']).all()
+        }
+
+        start = time.perf_counter()
+        positions = dict(zip(get_pks(path, meta).tolist(), itertools.count()))
+        n_added = n_replaced = 0
+        for chunk in iter(lambda: list(itertools.islice(rows, options['chunk_size'])), []):
+            added, replaced = self.write(path, meta, chunk, positions)
+            n_added, n_replaced = n_added + added, n_replaced + replaced
+        n_dropped = self.drop_deleted(path, meta, SessionSummary.objects.using(options['database']))
+        write_meta(path, meta)
+        self.stdout.write(
+            f"added {n_added}, replaced {n_replaced} and dropped {n_dropped} sessions "
+            f"in {time.perf_counter() - start:.1f} s, {meta['n_sessions']} sessions in {path}")
+
+    def drop_deleted(self, path, meta, summaries) -> int:
+        """Drop the sessions whose summary was deleted, which the watermark does not see."""
+        pks = get_pks(path, meta)
+        keep = np.isin(pks, np.fromiter(summaries.values_list("pk", flat=True).iterator(), dtype=np.int64))
+        if keep.all():
+            return 0
+        # their trials are left unused until a rebuild, like those of replaced sessions
+        drop_rows(path / "sessions", SESSION_COLUMNS, np.flatnonzero(keep))
+        meta["n_sessions"] = int(keep.sum())
+        write_meta(path, meta)
+        return int((~keep).sum())
+
+    def write(self, path, meta, chunk, positions):
+        """Append the new sessions of a chunk and replace the rows of the ones already stored."""
+        (pk, updated_at, completed_at, questionary, test, srt, digit_x50, triplet_x50,
+         age, first_time, normal_hearing, first_language, levels, n_correct) = zip(*chunk)
+
+        n_trials = np.array([len(x) for x in levels], dtype=np.int64)
+        sessions = {
+            "pk": pk,
+            "questionary": questionary,
+            "test": test,
+            "completed_at": [x.astimezone(timezone.utc).replace(tzinfo=None) for x in completed_at],
+            "srt": srt,
+            "digit_x50": [np.nan if x is None else x for x in digit_x50],
+            "triplet_x50": [np.nan if x is None else x for x in triplet_x50],
+            "age": age,
+            "first_time": first_time,
+            "normal_hearing": normal_hearing,
+            "first_language": first_language,
+            "start": meta["n_trials"] + np.r_[0, np.cumsum(n_trials)[:-1]],
+            "n_trials": n_trials,
+        }
+        sessions = {name: np.asarray(sessions[name], dtype=dtype) for name, dtype in SESSION_COLUMNS.items()}
+        trials = {
+            "level": list(itertools.chain.from_iterable(levels)),
+            "n_correct": list(itertools.chain.from_iterable(n_correct)),
+        }
+
+        # Trials are always appended and counted before any session points to
+        # them. The old trials of a replaced session are left unused until a rebuild.
+        append_table(path / "trials", TRIAL_COLUMNS, trials, meta["n_trials"])
+        meta["n_trials"] += int(n_trials.sum())
+        write_meta(path, meta)
+
+        rows = np.array([positions.get(x, -1) for x in pk], dtype=np.int64)
+        new = rows < 0
+        if not new.all():
+            update_table(path / "sessions", SESSION_COLUMNS,
+                         {name: values[~new] for name, values in sessions.items()}, rows[~new])
+        if new.any():
+            append_table(path / "sessions", SESSION_COLUMNS,
+                         {name: values[new] for name, values in sessions.items()}, meta["n_sessions"])
+            for i, x in enumerate(sessions["pk"][new].tolist()):
+                positions[x] = meta["n_sessions"] + i
+            meta["n_sessions"] += int(new.sum())
+        meta["watermark"] = {"updated_at": updated_at[-1].isoformat(), "pk": pk[-1]}
+        write_meta(path, meta)
+        return int(new.sum()), int((~new).sum())
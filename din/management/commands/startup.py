@@ -0,0 +1,94 @@
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter, so nothing is imported yet
+COLD_START = """
+import json, os, sys, time
+start = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.settings")
+from django.conf import settings
+from settings.wsgi import application
+timings = {"application": time.perf_counter() - start}
+from din.warmup import get_heavy_modules, get_memory
+from django.urls import get_resolver
+get_resolver().url_patterns
+timings["urls"] = time.perf_counter() - start
+from django.test import Client
+settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "testserver"]
+status = Client().get(sys.argv[1]).status_code
+timings["first_request"] = time.perf_counter() - start
+print(json.dumps({"timings": timings, "status": status, "memory": get_memory(), "modules": get_heavy_modules()}))
+"""
+
+
+def cold_start(path: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", COLD_START, path], cwd=settings.BASE_DIR, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise CommandError(f"Cold start failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def get_server_memory(pidfile: Path) -> list[dict]:
+    """The memory of a running gunicorn master and its workers."""
+    import psutil
+
+    from din.warmup import get_memory
+
+    try:
+        master = psutil.Process(int(pidfile.read_text()))
+    except (FileNotFoundError, ValueError, psutil.NoSuchProcess) as err:
+        raise CommandError(f"No running server for {pidfile}: {err}")
+    return [
+        {"role": role, "pid": process.pid, **get_memory(process.pid)}
+        for role, process in [("master", master), *(("worker", p) for p in master.children())]
+    ]
+
+
+class Command(BaseCommand):
+    help = "Measure the cold start time and memory of a worker, and of a running gunicorn"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help="number of cold starts")
+        parser.add_argument('--path', type=str, default="/", help="url of the first request")
+        parser.add_argument('--pidfile', type=Path, default=None, help="pidfile of a running gunicorn master")
+        parser.add_argument('--json', type=str, default=None, help="write the report to this file")
+
+    def handle(self, *args, **options):
+        runs = [cold_start(options['path']) for _ in range(options['repeat'])]
+        report = {
+            "cold_start": {
+                phase: round(statistics.median(run["timings"][phase] for run in runs), 3)
+                for phase in runs[0]["timings"]
+            },
+            "status": runs[0]["status"],
+            "memory": {
+                name: statistics.median(run["memory"][name] for run in runs) for name in runs[0]["memory"]
+            },
+            "modules": runs[0]["modules"],
+        }
+
+        self.stdout.write(f"cold start of a worker, median of {len(runs)}:")
+        for phase, seconds in report["cold_start"].items():
+            self.stdout.write(f"  {phase:<14} {seconds:7.3f} s")
+        self.stdout.write(f"  status of GET {options['path']}: {report['status']}")
+        self.stdout.write("  memory: " + ", ".join(f"{k} {v} MiB" for k, v in report["memory"].items()))
+        self.stdout.write(f"  loaded: {', '.join(report['modules']) or '-'}")
+
+        if options['pidfile'] is not None:
+            report["server"] = get_server_memory(options['pidfile'])
+            self.stdout.write(f"\n{'process':<8} {'pid':>8} " + " ".join(f"{k + ' MiB':>9}" for k in report["memory"]))
+            for process in report["server"]:
+                self.stdout.write(f"{process['role']:<8} {process['pid']:>8} " + " ".join(
+                    f"{process.get(k, float('nan')):>9.1f}" for k in report["memory"]))
+
+        if options['json']:
+            with open(options['json'], "w") as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from din.models import Test
+from din.analytics import summarize_sessions
+
+
+class Command(BaseCommand):
+    help = "Backfill the session summaries (SRT and psychometric fits) of completed tests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--test', type=int, default=None, help="only summarize this test id")
+        parser.add_argument('--force', action='store_true', help="recompute existing summaries")
+
+    def handle(self, *args, **options):
+        tests = Test.objects.all()
+        if options['test'] is not None:
+            tests = tests.filter(pk=options['test'])
+
+        self.stdout.write(f"summarized {summarize_sessions(tests, options['force'])}")
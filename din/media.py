@@ -0,0 +1,143 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# <test name>_<audio generator>/snr±NN/<label>.<extension>, see Stimulus.get_url
+STIMULUS_RE = re.compile(r"^[^/]+_[^/]+/snr[+-]\d{2}/[^/.]+\.(\w+)$")
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# the file, a part of it, or a revalidation of either, which must repeat the cache headers
+CACHEABLE_STATUS = (200, 206, 304)
+
+_hashes = {}
+_lock = threading.Lock()
+
+
+def get_hash(path: str, stat: os.stat_result = None) -> str:
+    """Content hash of a file, cached per process until its size or mtime changes."""
+    stat = stat or os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _hashes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    digest = hashlib.blake2b(digest_size=8)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    with _lock:
+        _hashes[path] = (key, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def media_url(name: str) -> str:
+    """The url of a media file, versioned by its content hash when it exists."""
+    url = f"{settings.MEDIA_URL}{name}"
+    try:
+        return f"{url}?v={get_hash(os.path.join(settings.MEDIA_ROOT, name))}"
+    except OSError:
+        return url
+
+
+def is_stimulus(path: str) -> bool:
+    from din.models import AUDIO_FORMATS
+
+    match = STIMULUS_RE.match(path)
+    extensions = {"wav", *(extension for extension, _ in AUDIO_FORMATS.values())}
+    return match is not None and match.group(1) in extensions
+
+
+def parse_range(header: str, size: int):
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start == "":
+        if end == "":
+            return None
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+def serve_media(request, path):
+    """Serve a stimulus with strong validators, range support and caching.
+
+    Only the audio files of stimuli are served, everything else below
+    ``MEDIA_ROOT`` is a 404. Requests for the current ``?v=`` version of a
+    file are cached as immutable. With ``MEDIA_SENDFILE_HEADER`` set, the
+    bytes are left to the web server through ``X-Accel-Redirect`` or
+    ``X-Sendfile``.
+    """
+    if not is_stimulus(path):
+        raise Http404(f"{path} not found")
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(fullpath)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404(f"{path} not found")
+    if not os.path.isfile(fullpath):
+        raise Http404(f"{path} not found")
+
+    version = get_hash(fullpath, stat)
+    etag = f'"{version}"'
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime)
+    )
+    if response is None:
+        response = _file_response(request, fullpath, path, stat.st_size, etag)
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    if response.status_code not in CACHEABLE_STATUS:
+        # a 416 or 412 must not be cached in place of the file
+        return response
+    if request.GET.get("v") == version:
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+    return response
+
+
+def _file_response(request, fullpath, path, size, etag):
+    content_type = mimetypes.guess_type(fullpath)[0] or "application/octet-stream"
+
+    sendfile_header = settings.MEDIA_SENDFILE_HEADER
+    if sendfile_header is not None:
+        response = HttpResponse(content_type=content_type)
+        if sendfile_header == "X-Accel-Redirect":
+            response[sendfile_header] = f"{settings.MEDIA_ACCEL_PREFIX}{path}"
+        else:
+            response[sendfile_header] = fullpath
+        return response
+
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if "Range" in request.headers and (if_range is None or if_range == etag):
+        byte_range = parse_range(request.headers["Range"], size)
+        if byte_range is not None and (byte_range[0] >= size or byte_range[0] > byte_range[1]):
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    if byte_range is None:
+        response = FileResponse(open(fullpath, "rb"), content_type=content_type)
+    else:
+        start, end = byte_range
+        with open(fullpath, "rb") as f:
+            f.seek(start)
+            response = HttpResponse(f.read(end - start + 1), content_type=content_type, status=206)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    response["Accept-Ranges"] = "bytes"
+    return response
@@ -0,0 +1,332 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, Http404
+from django.utils.crypto import constant_time_compare
+
+logger = logging.getLogger(__name__)
+
+HISTOGRAMS = {
+    "http_request_duration_seconds": (
+        "Latency of requests per view",
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    ),
+    "db_queries": (
+        "Database queries per request",
+        (0, 1, 2, 5, 10, 20, 50, 100, 200),
+    ),
+    "db_query_duration_seconds": (
+        "Time spent in database queries per request",
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+    ),
+    "http_response_size_bytes": (
+        "Size of response bodies per view",
+        (1e3, 1e4, 1e5, 1e6, 1e7),
+    ),
+}
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+def add_metrics(requests: dict, histograms: dict, data: dict):
+    """Add the metrics of one file to the totals."""
+    for *key, value in data["requests"]:
+        requests[tuple(key)] += value
+    for name, views in data["histograms"].items():
+        for view, histogram in views.items():
+            total = histograms[name].setdefault(view, {
+                "buckets": [0] * len(histogram["buckets"]), "sum": 0.0, "count": 0})
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+
+
+class MetricsStore:
+    """Per process request metrics, shared between workers through files.
+
+    Every process accumulates its metrics in memory and periodically writes
+    them to ``metrics-<pid>.json`` in ``root``. Reading the metrics sums the
+    files of all processes, so each gunicorn worker can serve the totals.
+    The counters are cumulative: the files of exited processes are merged
+    into ``metrics-exited.json``, by gunicorn's ``child_exit`` hook or by
+    the next read, so a reused pid never overwrites the counts of another
+    process.
+    """
+    exited = "metrics-exited.json"
+
+    def __init__(self, root, flush_interval: float = 5.0):
+        self.root = Path(root)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.flushed = False
+        self.last_flush = time.monotonic()
+        self.requests = defaultdict(int)
+        self.histograms = {
+            name: defaultdict(lambda n=len(buckets): {"buckets": [0] * (n + 1), "sum": 0.0, "count": 0})
+            for name, (_, buckets) in HISTOGRAMS.items()
+        }
+
+    def observe(self, name: str, view: str, value: float):
+        histogram = self.histograms[name][view]
+        buckets = HISTOGRAMS[name][1]
+        index = next((i for i, le in enumerate(buckets) if value <= le), len(buckets))
+        histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def record(self, view: str, method: str, status: int, duration: float,
+               n_queries: int, query_time: float, size: int = None):
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked after recording, start clean in the child
+                self.reset()
+            self.requests[view, method, str(status)] += 1
+            self.observe("http_request_duration_seconds", view, duration)
+            self.observe("db_queries", view, n_queries)
+            self.observe("db_query_duration_seconds", view, query_time)
+            if size is not None:
+                self.observe("http_response_size_bytes", view, size)
+        if time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "requests": [[*key, value] for key, value in self.requests.items()],
+                "histograms": {name: dict(views) for name, views in self.histograms.items()},
+            }
+
+    @contextmanager
+    def files_lock(self, shared: bool = False):
+        """Keeps readers from summing a file that is being merged twice."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / "metrics.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def read(path: Path):
+        try:
+            return json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write(self, name: str, data: dict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(data))
+        os.replace(tmp, self.root / name)
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if self.pid != os.getpid():
+            return
+        if not self.flushed:
+            # left by an exited process with the same pid
+            self.merge(self.pid)
+            self.flushed = True
+        self.write(f"metrics-{self.pid}.json", self.to_dict())
+
+    def merge(self, pid: int):
+        """Add the metrics of an exited process to the totals of exited processes."""
+        path = self.root / f"metrics-{pid}.json"
+        with self.files_lock():
+            data = self.read(path)
+            if data is None:
+                return
+            requests = defaultdict(int)
+            histograms = {name: {} for name in HISTOGRAMS}
+            for previous in (self.read(self.root / self.exited), data):
+                if previous is not None:
+                    add_metrics(requests, histograms, previous)
+            self.write(self.exited, {
+                "requests": [[*key, value] for key, value in requests.items()],
+                "histograms": histograms,
+            })
+            path.unlink()
+
+    def merge_exited(self):
+        for path in self.root.glob("metrics-*.json"):
+            pid = path.stem.split("-", 1)[1]
+            if pid.isdigit() and int(pid) != self.pid and not is_running(int(pid)):
+                self.merge(int(pid))
+
+    def collect(self) -> dict:
+        """The metrics summed over all processes."""
+        self.flush()
+        self.merge_exited()
+        requests = defaultdict(int)
+        histograms = {name: {} for name in HISTOGRAMS}
+        with self.files_lock(shared=True):
+            for path in self.root.glob("metrics-*.json"):
+                data = self.read(path)
+                if data is not None:
+                    add_metrics(requests, histograms, data)
+        return {"requests": requests, "histograms": histograms}
+
+    def render(self) -> str:
+        """The collected metrics in the Prometheus text exposition format."""
+        data = self.collect()
+        lines = [
+            "# HELP din_http_requests_total Requests per view, method and status",
+            "# TYPE din_http_requests_total counter",
+        ]
+        for (view, method, status), value in sorted(data["requests"].items()):
+            lines.append(f'din_http_requests_total{{view="{view}",method="{method}",status="{status}"}} {value}')
+
+        for name, (description, buckets) in HISTOGRAMS.items():
+            lines.append(f"# HELP din_{name} {description}")
+            lines.append(f"# TYPE din_{name} histogram")
+            for view, histogram in sorted(data["histograms"][name].items()):
+                cumulative = 0
+                for le, count in zip([*buckets, "+Inf"], histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f'din_{name}_bucket{{view="{view}",le="{le}"}} {cumulative}')
+                lines.append(f'din_{name}_sum{{view="{view}"}} {histogram["sum"]}')
+                lines.append(f'din_{name}_count{{view="{view}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+class QueryRecorder:
+    """The sql and duration of the queries of a request."""
+
+    def __init__(self):
+        self.queries = []
+
+    @property
+    def time(self) -> float:
+        return sum(duration for _, duration in self.queries)
+
+    def breakdown(self, n: int = 5):
+        """The ``n`` statements that took the longest in total, with their counts."""
+        totals = defaultdict(lambda: [0, 0.0])
+        for sql, duration in self.queries:
+            totals[sql][0] += 1
+            totals[sql][1] += duration
+        return sorted(totals.items(), key=lambda item: -item[1][1])[:n]
+
+
+# A context variable rather than a per connection wrapper, so queries of async
+# views that run on the sync thread are recorded for the request as well
+_recorder = ContextVar("query_recorder", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        recorder.queries.append((sql, time.perf_counter() - start))
+
+
+def install_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+metrics = MetricsStore(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
+atexit.register(metrics.flush)
+
+
+class MetricsMiddleware:
+    """Records latency, queries and response size per url name.
+
+    Requests slower than ``METRICS_SLOW_REQUEST`` seconds are logged with
+    the statements that took the most time.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        for connection in connections.all(initialized_only=True):
+            install_recorder(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        token = _recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self.record(request, response, recorder, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        token = _recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self.record(request, response, recorder, time.perf_counter() - start)
+        return response
+
+    def record(self, request, response, recorder, duration):
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else "unmatched"
+        size = None if response.streaming else len(response.content)
+        if size is None and response.has_header("Content-Length"):
+            size = int(response["Content-Length"])
+        metrics.record(view, request.method, response.status_code, duration,
+                       len(recorder.queries), recorder.time, size)
+
+        if duration > settings.METRICS_SLOW_REQUEST:
+            logger.warning(
+                "slow request %s %s (%s): %.3f s, %d queries in %.3f s\n%s",
+                request.method, request.path, view, duration,
+                len(recorder.queries), recorder.time,
+                "\n".join(f"  {count}x {total:.3f} s  {sql}" for sql, (count, total) in recorder.breakdown()),
+            )
+
+
+def metrics_view(request):
+    """The metrics in text format, for staff users or with ``METRICS_TOKEN`` as bearer token."""
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get("Authorization", "")
+    authorized = request.user.is_staff or (
+        token and constant_time_compare(authorization, f"Bearer {token}"))
+    if not authorized:
+        raise Http404()
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,6 +1,16 @@
+import logging
+
 from django.conf import settings
 from django.contrib.auth import get_user_model, login
+from django.db import OperationalError
+from django.http import HttpResponse
 from django.shortcuts import redirect
+from django.utils.deprecation import MiddlewareMixin
+
+from din.db import LOCKED_HEADER, is_locked
+
+logger = logging.getLogger(__name__)
+
 
 class DebugAutoLoginMiddleware:
     def __init__(self, get_response):
@@ -16,4 +26,22 @@ class DebugAutoLoginMiddleware:
             })
             login(request, user)
             return redirect(request.get_full_path())  # reload to apply login
-        return self.get_response(request)
\ No newline at end of file
+        return self.get_response(request)
+
+
+class DatabaseLockedMiddleware(MiddlewareMixin):
+    """Answers a request that failed on a locked database with 503 instead of 500.
+
+    These are the writes ``retry_on_locked`` gave up on. The response asks the
+    client to retry and is marked with ``LOCKED_HEADER``, so load tests over
+    HTTP can tell them from other errors.
+    """
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, OperationalError) or not is_locked(exception):
+            return None
+        logger.error("database locked: %s %s", request.method, request.path, exc_info=exception)
+        response = HttpResponse("The database is busy, please try again.", status=503, content_type="text/plain")
+        response["Retry-After"] = "1"
+        response[LOCKED_HEADER] = "1"
+        return response
@@ -0,0 +1,63 @@
+# Generated by Django 5.2 on 2026-10-18 11:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_sessions(apps, schema_editor):
+    Response = apps.get_model("din", "Response")
+    TestSession = apps.get_model("din", "TestSession")
+
+    sessions = {}
+    responses = (
+        Response.objects.select_related("stimulus", "test")
+        .exclude(answer="")
+        .order_by("questionary_id", "test_id", "index")
+    )
+    for response in responses.iterator():
+        test = response.test
+        correct = response.answer == response.stimulus.label
+        if correct:
+            level = max(response.stimulus.level - test.increment, test.min_level)
+        else:
+            level = min(response.stimulus.level + test.increment, test.max_level)
+        sessions[(response.questionary_id, test.pk)] = TestSession(
+            questionary_id=response.questionary_id,
+            test_id=test.pk,
+            index=response.index,
+            level=level,
+            last_correct=correct,
+        )
+    
+    started = Response.objects.values_list("questionary_id", "test__pk", "test__starting_level").distinct()
+    for questionary_id, test_id, starting_level in started:
+        if (questionary_id, test_id) not in sessions:
+            sessions[(questionary_id, test_id)] = TestSession(
+                questionary_id=questionary_id, test_id=test_id, level=starting_level
+            )
+    TestSession.objects.bulk_create(sessions.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('din', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField(default=0)),
+                ('level', models.IntegerField()),
+                ('last_correct', models.BooleanField(null=True)),
+                ('questionary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='din.questionary')),
+                ('test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='din.test')),
+            ],
+            options={
+                'unique_together': {('questionary', 'test')},
+            },
+        ),
+        migrations.RunPython(backfill_sessions, migrations.RunPython.noop),
+    ]
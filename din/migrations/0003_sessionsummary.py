@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 11:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('din', '0002_testsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('completed_at', models.DateTimeField(auto_now_add=True)),
+                ('srt', models.FloatField()),
+                ('digit_x50', models.FloatField(null=True)),
+                ('triplet_x50', models.FloatField(null=True)),
+                ('digit_fit', models.JSONField(null=True)),
+                ('triplet_fit', models.JSONField(null=True)),
+                ('levels', models.JSONField()),
+                ('n_correct', models.JSONField()),
+                ('questionary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='din.questionary')),
+                ('test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='din.test')),
+            ],
+            options={
+                'unique_together': {('questionary', 'test')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 11:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('din', '0003_sessionsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testsession',
+            name='seen',
+            field=models.JSONField(default=list),
+        ),
+    ]
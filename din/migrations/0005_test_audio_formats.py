@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('din', '0004_testsession_seen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='test',
+            name='audio_formats',
+            field=models.CharField(default='wav', max_length=100),
+        ),
+    ]
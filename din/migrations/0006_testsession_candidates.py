@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 11:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('din', '0005_test_audio_formats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testsession',
+            name='candidates',
+            field=models.JSONField(default=dict),
+        ),
+    ]
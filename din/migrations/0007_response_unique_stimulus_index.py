@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-18 11:35
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def remove_duplicate_responses(apps, schema_editor):
+    """Keep one response per (questionary, test, index), preferring answered ones."""
+    Response = apps.get_model("din", "Response")
+
+    duplicates = (
+        Response.objects.values("questionary_id", "test_id", "index")
+        .annotate(n=Count("pk"))
+        .filter(n__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        responses = Response.objects.filter(
+            questionary_id=duplicate["questionary_id"],
+            test_id=duplicate["test_id"],
+            index=duplicate["index"],
+        ).order_by("pk")
+        keep = next((r for r in responses if r.answer), responses[0])
+        responses.exclude(pk=keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('din', '0006_testsession_candidates'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_responses, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='response',
+            unique_together={('questionary', 'test', 'index')},
+        ),
+        migrations.AddIndex(
+            model_name='stimulus',
+            index=models.Index(fields=['test', 'level'], name='din_stimulu_test_id_2abfd8_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-18 14:10
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def set_updated_at(apps, schema_editor):
+    SessionSummary = apps.get_model("din", "SessionSummary")
+    SessionSummary.objects.update(updated_at=F("completed_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('din', '0008_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sessionsummary',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='sessionsummary',
+            index=models.Index(fields=['updated_at', 'id'], name='din_session_updated_idx'),
+        ),
+        migrations.RunPython(set_updated_at, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,35 @@
 import numpy as np
 
-from django.conf import settings
 from django.db import models
+from django.db.models import Avg, Count, OuterRef, StdDev, Subquery
+
+from din.media import media_url
+
+# Encoded audio formats as (extension, mime type), in order of preference
+AUDIO_FORMATS = {
+    "opus": ("opus", 'audio/ogg; codecs="opus"'),
+    "mp3": ("mp3", "audio/mpeg"),
+    "flac": ("flac", "audio/flac"),
+    "wav": ("wav", "audio/wav"),
+}
+
+def _per_test(queryset, aggregate):
+    return Subquery(
+        queryset.filter(test=OuterRef("pk"))
+        .values("test")
+        .annotate(value=aggregate)
+        .values("value")
+    )
+
+
+class TestQuerySet(models.QuerySet):
+    def with_stats(self):
+        return self.annotate(
+            response_count=_per_test(Response.objects, Count("pk")),
+            completed_count=_per_test(SessionSummary.objects, Count("pk")),
+            mean_srt=_per_test(SessionSummary.objects, Avg("srt")),
+            std_srt=_per_test(SessionSummary.objects, StdDev("srt")),
+        )
 
 
 class Test(models.Model):
@@ -15,10 +43,18 @@ class Test(models.Model):
     name = models.CharField(max_length=100, default="din")
     audio_generator = models.CharField(max_length=100, default="din")
     active = models.BooleanField()
+    audio_formats = models.CharField(max_length=100, default="wav")
+
+    objects = TestQuerySet.as_manager()
+
+    @property
+    def formats(self):
+        available = set(self.audio_formats.split(",")) | {"wav"}
+        return [fmt for fmt in AUDIO_FORMATS if fmt in available]
     
     @property
     def n_responses(self):
-        return len(self.response_set.all())
+        return self.response_set.count()
     
     @property
     def n_completed(self):
@@ -34,14 +70,7 @@ class Test(models.Model):
     
     
     def get_snrs(self):
-        result = []
-        for responses in self.iter_entries(True):
-            levels = np.array([x.stimulus.level for x in responses])
-            snr_levels = np.r_[
-                levels[-20:], Response.get_next_level(responses.last())
-            ]
-            result.append(np.mean(snr_levels))
-        return result
+        return list(self.sessionsummary_set.values_list("srt", flat=True))
             
     @property
     def mean_snr(self):
@@ -51,6 +80,20 @@ class Test(models.Model):
     def std_snr(self):
         return np.std(self.get_snrs())
 
+    def get_next_level(self, level: int, correct: bool) -> int:
+        if correct:
+            return max(level - self.increment, self.min_level)
+        return min(level + self.increment, self.max_level)
+
+    def get_session(self, questionary_id: int) -> "TestSession":
+        session, _ = TestSession.objects.get_or_create(
+            questionary_id=questionary_id,
+            test=self,
+            defaults={"level": self.starting_level},
+        )
+        session.test = self
+        return session
+
 
 class Stimulus(models.Model):
     name = models.CharField(max_length=100)
@@ -58,16 +101,28 @@ class Stimulus(models.Model):
     level = models.IntegerField()
     label = models.CharField(max_length=3)
 
+    class Meta:
+        indexes = [models.Index(fields=["test", "level"])]
+
     @property
     def filename(self):
         return f"{self.label}.wav"
     
+    def get_url(self, extension: str = "wav"):
+        return media_url(
+            f"{self.test.name}_{self.test.audio_generator}"
+            f"/snr{self.level:+03d}/{self.label}.{extension}")
+
     @property
     def static_url(self):
-        return (
-            f"{settings.MEDIA_URL}"
-            f"{self.test.name}_{self.test.audio_generator}"
-            f"/snr{self.level:+03d}/{self.filename}")
+        return self.get_url()
+
+    @property
+    def sources(self):
+        return [
+            (self.get_url(AUDIO_FORMATS[fmt][0]), AUDIO_FORMATS[fmt][1])
+            for fmt in self.test.formats
+        ]
 
 
 class Questionary(models.Model):
@@ -85,6 +140,9 @@ class Response(models.Model):
     test = models.ForeignKey(Test, on_delete=models.CASCADE)
     answer = models.CharField(max_length=3)
 
+    class Meta:
+        unique_together = ("questionary", "test", "index")
+
     @property
     def answered(self):
         return len(self.answer) != 0
@@ -104,13 +162,8 @@ class Response(models.Model):
     
     @staticmethod
     def get_next_level(previous_question: "Response"):
-        if previous_question.correct:
-            return max(
-                previous_question.stimulus.level - previous_question.test.increment,
-                previous_question.test.min_level,
-            )
-        return min(
-            previous_question.stimulus.level + previous_question.test.increment, previous_question.test.max_level
+        return previous_question.test.get_next_level(
+            previous_question.stimulus.level, previous_question.correct
         )
         
     def get_level(self):
@@ -123,3 +176,157 @@ class Response(models.Model):
             test=self.test,
         )
         return Response.get_next_level(previous_question)
+
+
+class TestSession(models.Model):
+    """Adaptive staircase state of a single (questionary, test) run.
+
+    ``level`` is the SNR level of the next question to be served, which is
+    question ``index + 1``.
+    """
+    questionary = models.ForeignKey(Questionary, on_delete=models.CASCADE)
+    test = models.ForeignKey(Test, on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField(default=0)
+    level = models.IntegerField()
+    last_correct = models.BooleanField(null=True)
+    seen = models.JSONField(default=list)
+    candidates = models.JSONField(default=dict)
+
+    class Meta:
+        unique_together = ("questionary", "test")
+
+    def get_level(self, response: Response) -> int:
+        if response.index == self.index + 1:
+            return self.level
+        return response.get_level()
+
+    def get_candidates(self, index: int) -> dict:
+        if self.candidates.get("index") != index:
+            return {}
+        return {int(level): pk for level, pk in self.candidates["levels"].items()}
+
+    def next_stimulus(self, response: Response, stimuli) -> "Stimulus":
+        level = self.get_level(response)
+        pk = self.get_candidates(response.index).get(level)
+        stimulus = stimuli.get(level, pk) if pk is not None else None
+        return stimulus or stimuli.sample(level, self.seen)
+
+    def prefetch(self, response: Response, stimuli):
+        """Draw the stimuli of both possible next questions in advance."""
+        self.candidates = {}
+        if response.index < self.test.n_questions:
+            exclude = [*self.seen, response.stimulus.label]
+            levels = {
+                self.test.get_next_level(response.stimulus.level, correct)
+                for correct in (True, False)
+            }
+            self.candidates = {
+                "index": response.index + 1,
+                "levels": {str(level): stimuli.sample(level, exclude).pk for level in levels},
+            }
+        self.save(update_fields=["candidates"])
+
+    def record(self, response: Response):
+        if self.index < response.index:
+            # only once, the write may be retried
+            self.seen.append(response.stimulus.label)
+        self.index = response.index
+        self.last_correct = response.correct
+        self.level = self.test.get_next_level(
+            response.stimulus.level, self.last_correct
+        )
+        self.save(update_fields=["index", "level", "last_correct", "seen"])
+
+    def summarize(self) -> "SessionSummary":
+        responses = Response.objects.filter(
+            questionary_id=self.questionary_id, test=self.test
+        ).select_related("stimulus").order_by("index")
+        return SessionSummary.from_responses(self.test, responses)
+
+
+class SessionSummary(models.Model):
+    questionary = models.ForeignKey(Questionary, on_delete=models.CASCADE)
+    test = models.ForeignKey(Test, on_delete=models.CASCADE)
+    completed_at = models.DateTimeField(auto_now_add=True)
+    # changes when a summary is recomputed, the analysis snapshot follows it
+    updated_at = models.DateTimeField(auto_now=True)
+    srt = models.FloatField()
+    digit_x50 = models.FloatField(null=True)
+    triplet_x50 = models.FloatField(null=True)
+    digit_fit = models.JSONField(null=True)
+    triplet_fit = models.JSONField(null=True)
+    levels = models.JSONField()
+    n_correct = models.JSONField()
+
+    class Meta:
+        unique_together = ("questionary", "test")
+        indexes = [models.Index(fields=["updated_at", "id"], name="din_session_updated_idx")]
+
+    @property
+    def fits(self):
+        return self.digit_fit, self.triplet_fit
+
+    @classmethod
+    def store(cls, questionary_id: int, test_id: int, levels, n_correct, srt: float) -> "SessionSummary":
+        from din.utils import get_x50, fit_psychometric
+
+        levels, n_correct = [int(x) for x in levels], [int(x) for x in n_correct]
+        digit_fit, triplet_fit = fit_psychometric(levels, n_correct)
+        summary, _ = cls.objects.update_or_create(
+            questionary_id=questionary_id,
+            test_id=test_id,
+            defaults={
+                "srt": float(srt),
+                "digit_x50": float(get_x50(*digit_fit)) if digit_fit else None,
+                "triplet_x50": float(get_x50(*triplet_fit)) if triplet_fit else None,
+                "digit_fit": digit_fit,
+                "triplet_fit": triplet_fit,
+                "levels": levels,
+                "n_correct": n_correct,
+            },
+        )
+        return summary
+
+    @classmethod
+    def from_responses(cls, test: Test, responses) -> "SessionSummary":
+        from din.utils import get_srt
+
+        responses = list(responses)
+        last = responses[-1]
+        levels = [x.stimulus.level for x in responses]
+        n_correct = [x.n_correct for x in responses]
+        srt = get_srt(levels, test.get_next_level(levels[-1], last.correct))
+        return cls.store(last.questionary_id, test.pk, levels, n_correct, srt)
+
+
+class Job(models.Model):
+    """A background job, run by the ``run_jobs`` worker (see ``din.jobs``).
+
+    ``key`` identifies the work, so a job is queued at most once while it is
+    pending or running.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(status, status) for status in (PENDING, RUNNING, DONE, FAILED)]
+
+    kind = models.CharField(max_length=32)
+    key = models.CharField(max_length=128, unique=True)
+    args = models.JSONField(default=dict)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    result = models.JSONField(null=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "updated_at"])]
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
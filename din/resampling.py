@@ -0,0 +1,145 @@
+"""Bootstrap and permutation comparisons of the SRTs of all pairs of conditions.
+
+Replicates of every pair are drawn at once as batched index arrays, in chunks
+of ``chunk_size`` replicates, so memory stays at
+``n_pairs * chunk_size * n_max`` values however many replicates are drawn.
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+from statsmodels.stats.multitest import multipletests
+
+
+def get_pairs(values, groups, subjects=None, paired: bool = False):
+    """The samples of every pair of groups as padded (n_pairs, n_max) arrays.
+
+    Unpaired, row i holds the values of the first group followed by those of
+    the second. Paired, it holds the differences of the subjects in both.
+    Returns the pairs, the padded values and the sizes (n_a, n_b) per pair.
+    """
+    values, groups = np.asarray(values, dtype=np.float64), np.asarray(groups)
+    names = list(dict.fromkeys(groups.tolist()))
+    pairs = list(itertools.combinations(names, 2))
+
+    samples, sizes = [], []
+    for a, b in pairs:
+        if paired:
+            x = pd.Series(values[groups == a], index=np.asarray(subjects)[groups == a])
+            y = pd.Series(values[groups == b], index=np.asarray(subjects)[groups == b])
+            common = x.index.intersection(y.index)
+            samples.append((x[common] - y[common]).to_numpy())
+            sizes.append((len(common), 0))
+        else:
+            x, y = values[groups == a], values[groups == b]
+            samples.append(np.r_[x, y])
+            sizes.append((len(x), len(y)))
+
+    n_max = max(len(sample) for sample in samples)
+    padded = np.zeros((len(pairs), n_max))
+    for i, sample in enumerate(samples):
+        padded[i, :len(sample)] = sample
+    return pairs, padded, np.array(sizes)
+
+
+def iter_chunks(n_resamples: int, chunk_size: int):
+    for start in range(0, n_resamples, chunk_size):
+        yield min(chunk_size, n_resamples - start)
+
+
+def bootstrap(padded, sizes, paired: bool, n_resamples: int, chunk_size: int, rng):
+    """Bootstrap replicates of the mean (difference) per pair, (n_pairs, n_resamples)."""
+    n_a, n_b = sizes[:, 0, None, None], sizes[:, 1, None, None]
+    n_pairs, n_max = padded.shape
+    rows = np.arange(n_pairs)[:, None, None]
+    replicates = []
+    for n in iter_chunks(n_resamples, chunk_size):
+        u = rng.random((n_pairs, n, n_max))
+        if paired:
+            index = (u * n_a).astype(np.int64)
+            mask = np.arange(n_max) < n_a
+            replicates.append((padded[rows, index] * mask).sum(axis=2) / n_a[..., 0])
+        else:
+            # the first n_a positions draw from group a, the next n_b from group b
+            position = np.arange(n_max)
+            in_a, in_b = position < n_a, (position >= n_a) & (position < n_a + n_b)
+            index = np.where(in_a, u * n_a, n_a + u * n_b).astype(np.int64)
+            drawn = padded[rows, np.minimum(index, n_max - 1)]
+            mean_a = (drawn * in_a).sum(axis=2) / n_a[..., 0]
+            mean_b = (drawn * in_b).sum(axis=2) / n_b[..., 0]
+            replicates.append(mean_a - mean_b)
+    return np.concatenate(replicates, axis=1)
+
+
+def permutation(padded, sizes, paired: bool, n_resamples: int, chunk_size: int, rng):
+    """Replicates of the statistic under the null hypothesis, (n_pairs, n_resamples).
+
+    Paired samples flip the signs of the differences, unpaired samples shuffle
+    the group labels by sorting random keys, with the padding sorted last.
+    """
+    n_a, n_b = sizes[:, 0, None, None], sizes[:, 1, None, None]
+    n_pairs, n_max = padded.shape
+    rows = np.arange(n_pairs)[:, None, None]
+    position = np.arange(n_max)
+    replicates = []
+    for n in iter_chunks(n_resamples, chunk_size):
+        if paired:
+            signs = rng.choice([-1.0, 1.0], (n_pairs, n, n_max))
+            replicates.append((padded[:, None] * signs).sum(axis=2) / n_a[..., 0])
+        else:
+            keys = rng.random((n_pairs, n, n_max))
+            keys[np.broadcast_to(position >= n_a + n_b, keys.shape)] = 2.0
+            shuffled = padded[rows, np.argsort(keys, axis=2)]
+            sum_a = (shuffled * (position < n_a)).sum(axis=2)
+            total = padded.sum(axis=1)[:, None]
+            replicates.append(sum_a / n_a[..., 0] - (total - sum_a) / n_b[..., 0])
+    return np.concatenate(replicates, axis=1)
+
+
+def compare_groups(values, groups, subjects=None, paired: bool = False, n_resamples: int = 10_000,
+                   chunk_size: int = 1_000, delta: float = 1.0, alpha: float = 0.05,
+                   correction: str = "holm", seed=None) -> pd.DataFrame:
+    """Compare the mean of every pair of groups by resampling.
+
+    Per pair: the observed mean difference, its percentile bootstrap CI at
+    ``1 - alpha``, the ``1 - 2 alpha`` CI used for the TOST equivalence test
+    with margin ``delta``, and the two-sided permutation p-value, corrected
+    for the number of pairs with ``correction`` (see statsmodels' multipletests).
+    With ``paired``, only subjects present in both groups are compared.
+    """
+    if paired and subjects is None:
+        raise ValueError("paired comparisons need the subject of every value")
+    rng = np.random.default_rng(seed)
+    pairs, padded, sizes = get_pairs(values, groups, subjects, paired)
+    n_a, n_b = sizes[:, 0], sizes[:, 1]
+    if paired:
+        observed = padded.sum(axis=1) / n_a
+    else:
+        position = np.arange(padded.shape[1])
+        mean_a = (padded * (position < n_a[:, None])).sum(axis=1) / n_a
+        mean_b = (padded * (position >= n_a[:, None])).sum(axis=1) / n_b
+        observed = mean_a - mean_b
+
+    boot = bootstrap(padded, sizes, paired, n_resamples, chunk_size, rng)
+    ci = np.quantile(boot, [alpha / 2, 1 - alpha / 2], axis=1)
+    tost = np.quantile(boot, [alpha, 1 - alpha], axis=1)
+
+    null = permutation(padded, sizes, paired, n_resamples, chunk_size, rng)
+    p = (1 + (np.abs(null) >= np.abs(observed)[:, None] - 1e-12).sum(axis=1)) / (1 + n_resamples)
+    p_corrected = multipletests(p, alpha=alpha, method=correction)[1]
+
+    return pd.DataFrame({
+        "a": [a for a, _ in pairs],
+        "b": [b for _, b in pairs],
+        "n_a": n_a,
+        "n_b": n_a if paired else n_b,
+        "paired": paired,
+        "diff": observed,
+        "ci_low": ci[0],
+        "ci_high": ci[1],
+        "tost_low": tost[0],
+        "tost_high": tost[1],
+        "equivalent": (tost[0] > -delta) & (tost[1] < delta),
+        "p": p,
+        "p_corrected": p_corrected,
+    })
@@ -0,0 +1,155 @@
+"""Columnar, memory-mappable snapshot of the completed sessions.
+
+The snapshot is a directory of ``.npy`` files, one per column, for a
+``sessions`` table and a flat ``trials`` table with the level and number of
+correct digits of every question; ``sessions["start"]`` and
+``sessions["n_trials"]`` index into the trials. ``meta.json`` holds the row
+counts and the watermark up to which sessions were updated, so an update only
+reads what changed since: new sessions are appended, recomputed sessions
+replace their row, keyed by ``sessions["pk"]``, and point to a fresh copy of
+their trials, and the rows of deleted sessions are dropped. Reading needs only
+NumPy, not Django:
+
+    from din.snapshot import load_snapshot
+    snapshot = load_snapshot("cache/snapshot")
+    srt = snapshot["sessions"]["srt"]
+"""
+import io
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+SNAPSHOT_VERSION = 2
+
+SESSION_COLUMNS = {
+    "pk": np.int64,
+    "questionary": np.int64,
+    "test": np.int64,
+    "completed_at": "datetime64[us]",
+    "srt": np.float64,
+    "digit_x50": np.float64,
+    "triplet_x50": np.float64,
+    "age": np.int16,
+    "first_time": bool,
+    "normal_hearing": bool,
+    "first_language": bool,
+    "start": np.int64,
+    "n_trials": np.int16,
+}
+TRIAL_COLUMNS = {
+    "level": np.int16,
+    "n_correct": np.int8,
+}
+
+
+def read_meta(path) -> dict:
+    try:
+        return json.loads((Path(path) / "meta.json").read_text())
+    except FileNotFoundError:
+        return {"version": SNAPSHOT_VERSION, "n_sessions": 0, "n_trials": 0, "watermark": None, "tests": {}}
+
+
+def write_meta(path, meta: dict):
+    tmp = Path(path) / "meta.json.tmp"
+    tmp.write_text(json.dumps(meta, indent=2))
+    os.replace(tmp, Path(path) / "meta.json")
+
+
+def append_npy(path: Path, values: np.ndarray, n_rows: int):
+    """Append ``values`` after the first ``n_rows`` rows of a 1d ``.npy`` file.
+
+    Rows past ``n_rows``, left by an interrupted update, are overwritten. The
+    header is rewritten in place, NumPy leaves room in it for the shape to grow.
+    """
+    values = np.ascontiguousarray(values)
+    if not path.exists() or n_rows == 0:
+        np.save(path, values)
+        return
+
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        _, _, dtype = read_header(f)
+        offset = f.tell()
+
+        write_header = (
+            np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        )
+        header = io.BytesIO()
+        write_header(header, {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": (n_rows + len(values), ),
+        })
+        if len(header.getvalue()) == offset and dtype == values.dtype:
+            f.seek(offset + n_rows * dtype.itemsize)
+            f.write(values.tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    existing = np.load(path, mmap_mode="r")[:n_rows]
+    np.save(path, np.concatenate([existing, values.astype(existing.dtype)]))
+
+
+def append_table(path: Path, columns: dict, values: dict, n_rows: int):
+    path.mkdir(parents=True, exist_ok=True)
+    for name, dtype in columns.items():
+        append_npy(path / f"{name}.npy", np.asarray(values[name], dtype=dtype), n_rows)
+
+
+def update_table(path: Path, columns: dict, values: dict, rows: np.ndarray):
+    """Overwrite ``rows`` of every column of a table in place."""
+    for name, dtype in columns.items():
+        column = np.load(path / f"{name}.npy", mmap_mode="r+")
+        column[rows] = np.asarray(values[name], dtype=dtype)
+        column.flush()
+        del column
+
+
+def drop_rows(path: Path, columns: dict, keep: np.ndarray):
+    """Rewrite a table with only the ``keep`` rows.
+
+    The table is written next to the old one and swapped in, readers that
+    have the old files open keep reading them.
+    """
+    new, old = path.with_name(f"{path.name}.new"), path.with_name(f"{path.name}.old")
+    shutil.rmtree(new, ignore_errors=True)
+    new.mkdir()
+    for name in columns:
+        np.save(new / f"{name}.npy", np.load(path / f"{name}.npy", mmap_mode="r")[keep])
+    shutil.rmtree(old, ignore_errors=True)
+    os.rename(path, old)
+    os.rename(new, path)
+    shutil.rmtree(old)
+
+
+def load_snapshot(path, mmap_mode: str = "r") -> dict:
+    """Open the tables of a snapshot, memory-mapped unless ``mmap_mode`` is None."""
+    path = Path(path)
+    meta = read_meta(path)
+
+    def load(table, columns, n_rows):
+        return {
+            name: np.load(path / table / f"{name}.npy", mmap_mode=mmap_mode)[:n_rows]
+            if n_rows else np.array([], dtype=dtype)
+            for name, dtype in columns.items()
+        }
+
+    return {
+        "sessions": load("sessions", SESSION_COLUMNS, meta["n_sessions"]),
+        "trials": load("trials", TRIAL_COLUMNS, meta["n_trials"]),
+        "tests": {int(pk): test for pk, test in meta["tests"].items()},
+        "meta": meta,
+    }
+
+
+def get_trials(snapshot: dict, i: int) -> dict:
+    """The trials of the ``i``-th session of a snapshot."""
+    start = snapshot["sessions"]["start"][i]
+    stop = start + snapshot["sessions"]["n_trials"][i]
+    return {name: column[start:stop] for name, column in snapshot["trials"].items()}
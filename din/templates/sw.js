@@ -0,0 +1,88 @@
+{% load static %}
+// Precaches the calibration audio and caches versioned stimuli, so the next
+// trial starts without waiting on the network.
+const CACHE_NAME = 'din-audio-v1';
+const PRECACHE = [
+    "{% static 'audio/soft_test.wav' %}",
+    "{% static 'audio/loud_test.wav' %}",
+    "{% static 'audio/din/tripletnoise.wav' %}",
+    "{% static 'audio/din/triplets/046.wav' %}",
+];
+const PRECACHE_PATHS = PRECACHE.map((url) => new URL(url, self.location).pathname);
+const MEDIA_PATH = new URL("{{ media_url }}", self.location).pathname;
+const MAX_ENTRIES = 500;
+
+self.addEventListener('install', (event) => {
+    event.waitUntil(
+        caches.open(CACHE_NAME).then((cache) => cache.addAll(PRECACHE)).then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(
+        caches.keys().then((keys) => Promise.all(
+            keys.filter((key) => key !== CACHE_NAME).map((key) => caches.delete(key))
+        )).then(() => self.clients.claim())
+    );
+});
+
+function cacheable(url) {
+    if (PRECACHE_PATHS.includes(url.pathname)) {
+        return true;
+    }
+    // Stimulus urls are versioned by their content hash, so they never change
+    return url.pathname.startsWith(MEDIA_PATH) && url.searchParams.has('v');
+}
+
+// Answer a Range request from a full cached response
+async function slice(request, response) {
+    const match = /^bytes=(\d*)-(\d*)$/.exec(request.headers.get('range') || '');
+    if (!match || (match[1] === '' && match[2] === '')) {
+        return response;
+    }
+    const body = await response.arrayBuffer();
+    const size = body.byteLength;
+    let start = match[1] === '' ? Math.max(size - Number(match[2]), 0) : Number(match[1]);
+    let end = match[1] === '' || match[2] === '' ? size - 1 : Math.min(Number(match[2]), size - 1);
+    if (start >= size || start > end) {
+        return new Response(null, {status: 416, headers: {'Content-Range': `bytes */${size}`}});
+    }
+    return new Response(body.slice(start, end + 1), {
+        status: 206,
+        headers: {
+            'Content-Type': response.headers.get('Content-Type') || '',
+            'Content-Range': `bytes ${start}-${end}/${size}`,
+            'Content-Length': String(end - start + 1),
+        },
+    });
+}
+
+// Drop the oldest stimuli, keys are returned in insertion order
+async function trim(cache) {
+    const keys = (await cache.keys()).filter((request) => !PRECACHE_PATHS.includes(new URL(request.url).pathname));
+    for (const request of keys.slice(0, Math.max(keys.length - MAX_ENTRIES, 0))) {
+        await cache.delete(request);
+    }
+}
+
+async function fromCache(request) {
+    const cache = await caches.open(CACHE_NAME);
+    let response = await cache.match(request.url);
+    if (!response) {
+        // Always fetch the whole file, partial responses can not be cached
+        response = await fetch(request.url, {credentials: 'same-origin'});
+        if (response.status !== 200) {
+            return response;
+        }
+        await cache.put(request.url, response.clone());
+        trim(cache);
+    }
+    return slice(request, response);
+}
+
+self.addEventListener('fetch', (event) => {
+    const url = new URL(event.request.url);
+    if (event.request.method === 'GET' && url.origin === self.location.origin && cacheable(url)) {
+        event.respondWith(fromCache(event.request));
+    }
+});
@@ -0,0 +1,389 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from din import jobs
+from din.analytics import summarize_sessions
+from din.db import LOCKED_HEADER
+from din.media import get_hash
+from din.metrics import MetricsStore
+from din.snapshot import load_snapshot
+from din.models import Job, Questionary, Response, SessionSummary, Stimulus, Test, TestSession
+from din.utils import fit_psychometric, fit_psychometric_batch, get_srt, get_x50
+from din.views import answer_question, get_question
+
+
+def create_test(n_questions: int = 24, n_labels: int = 12, **kwargs) -> Test:
+    test = Test.objects.create(n_questions=n_questions, active=True, **kwargs)
+    Stimulus.objects.bulk_create([
+        Stimulus(test=test, level=level, label=f"{i:03d}", name=f"{i:03d}")
+        for level in range(test.min_level, test.max_level + 1)
+        for i in range(n_labels)
+    ])
+    return test
+
+
+def create_questionary() -> Questionary:
+    return Questionary.objects.create(
+        age=30, normal_hearing=True, approve=True, first_time=True, first_language=True)
+
+
+def run_session(test: Test, questionary: Questionary, correct=lambda index: index % 3 != 0):
+    """Answer every question of a test, correctly where ``correct(index)``."""
+    for index in range(1, test.n_questions + 1):
+        session, response, _ = get_question(questionary.pk, test, index)
+        label = response.stimulus.label
+        answer_question(test, session, response, label if correct(index) else "999")
+
+
+class StaircaseTests(TestCase):
+    def setUp(self):
+        self.test = create_test()
+        self.questionary = create_questionary()
+
+    def test_level_follows_answers(self):
+        session, response, _ = get_question(self.questionary.pk, self.test, 1)
+        self.assertEqual(response.stimulus.level, self.test.starting_level)
+
+        answer_question(self.test, session, response, response.stimulus.label)
+        session.refresh_from_db()
+        self.assertEqual(session.index, 1)
+        self.assertTrue(session.last_correct)
+        self.assertEqual(session.level, self.test.starting_level - self.test.increment)
+
+        session, response, _ = get_question(self.questionary.pk, self.test, 2)
+        self.assertEqual(response.stimulus.level, self.test.starting_level - self.test.increment)
+        answer_question(self.test, session, response, "999")
+        session.refresh_from_db()
+        self.assertFalse(session.last_correct)
+        self.assertEqual(session.level, self.test.starting_level)
+        self.assertEqual(len(session.seen), 2)
+
+    def test_answer_is_stored_once(self):
+        session, response, _ = get_question(self.questionary.pk, self.test, 1)
+        answer_question(self.test, session, response, response.stimulus.label)
+        session, response, _ = get_question(self.questionary.pk, self.test, 1)
+        answer_question(self.test, session, response, "999")
+        response.refresh_from_db()
+        self.assertEqual(response.answer, response.stimulus.label)
+        self.assertEqual(TestSession.objects.get(pk=session.pk).index, 1)
+
+    def test_constant_queries_per_question(self):
+        def count_queries(index):
+            with CaptureQueriesContext(connection) as context:
+                session, response, _ = get_question(self.questionary.pk, self.test, index)
+                answer_question(self.test, session, response, response.stimulus.label)
+            return len(context.captured_queries)
+
+        counts = [count_queries(index) for index in range(1, 21)]
+        # the first question also creates the session and fills the stimulus catalog
+        self.assertEqual(len(set(counts[1:-1])), 1, counts)
+
+
+@override_settings(JOBS_EAGER=False)
+class SummaryTests(TestCase):
+    def setUp(self):
+        self.test = create_test(n_questions=8)
+        self.questionary = create_questionary()
+
+    def test_completion_queues_summary(self):
+        run_session(self.test, self.questionary)
+        job = Job.objects.get()
+        self.assertEqual(job.key, f"summary:{self.questionary.pk}:{self.test.pk}")
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertFalse(SessionSummary.objects.exists())
+
+    def test_summary_matches_responses(self):
+        run_session(self.test, self.questionary)
+        summary = TestSession.objects.get(questionary=self.questionary, test=self.test).summarize()
+
+        responses = Response.objects.filter(test=self.test).select_related("stimulus").order_by("index")
+        levels = [r.stimulus.level for r in responses]
+        last = responses.last()
+        srt = get_srt(levels, self.test.get_next_level(last.stimulus.level, last.correct))
+        self.assertAlmostEqual(summary.srt, srt)
+        self.assertEqual(summary.levels, levels)
+        self.assertEqual(summary.n_correct, [r.n_correct for r in responses])
+        self.assertEqual(self.test.get_snrs(), [summary.srt])
+
+    def test_backfill_matches_summary(self):
+        run_session(self.test, self.questionary)
+        self.assertEqual(summarize_sessions(), 1)
+        srt = SessionSummary.objects.get().srt
+        self.assertEqual(summarize_sessions(), 0)
+
+        summary = TestSession.objects.get(questionary=self.questionary, test=self.test).summarize()
+        self.assertAlmostEqual(summary.srt, srt)
+        self.assertEqual(SessionSummary.objects.count(), 1)
+
+
+@override_settings(JOBS_EAGER=False)
+class ResultOverviewTests(TestCase):
+    def setUp(self):
+        self.tests = [create_test(n_questions=4), create_test(n_questions=4)]
+        staff = User.objects.create_user("staff", is_staff=True)
+        self.client.force_login(staff)
+
+    def add_participants(self, n: int):
+        for _ in range(n):
+            questionary = create_questionary()
+            for test in self.tests:
+                run_session(test, questionary)
+                TestSession.objects.get(questionary=questionary, test=test).summarize()
+
+    def test_constant_queries(self):
+        self.add_participants(1)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get("/results/").status_code, 200)
+
+        self.add_participants(5)
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get("/results/")
+        self.assertEqual(len(response.context["questionaries"]), 6)
+        self.assertEqual([t.completed_count for t in response.context["tests"]], [6, 6])
+
+
+class RetryTests(TransactionTestCase):
+    """Writes retried after a lock error, which needs real transactions."""
+
+    def test_answer_survives_locked_database(self):
+        test = create_test(n_questions=4)
+        questionary = create_questionary()
+        session, response, _ = get_question(questionary.pk, test, 1)
+
+        record = TestSession.record
+        calls = []
+
+        def locked_once(self, response):
+            calls.append(response.index)
+            if len(calls) == 1:
+                raise OperationalError("database is locked")
+            return record(self, response)
+
+        with mock.patch.object(TestSession, "record", locked_once), mock.patch("din.db.time.sleep"):
+            answer_question(test, session, response, response.stimulus.label)
+
+        self.assertEqual(len(calls), 2)
+        response.refresh_from_db()
+        self.assertEqual(response.answer, response.stimulus.label)
+        session.refresh_from_db()
+        self.assertEqual(session.index, 1)
+        self.assertEqual(len(session.seen), 1)
+
+    @override_settings(JOBS_EAGER=False)
+    def test_last_answer_queues_summary_after_retry(self):
+        test = create_test(n_questions=1)
+        questionary = create_questionary()
+        session, response, _ = get_question(questionary.pk, test, 1)
+
+        enqueue = jobs.enqueue
+        calls = []
+
+        def locked_once(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError("database is locked")
+            return enqueue(*args, **kwargs)
+
+        with mock.patch.object(jobs, "enqueue", locked_once), mock.patch("din.db.time.sleep"):
+            answer_question(test, session, response, response.stimulus.label)
+
+        self.assertEqual(Job.objects.get().key, f"summary:{questionary.pk}:{test.pk}")
+        self.assertEqual(Response.objects.get().answer, response.stimulus.label)
+
+
+class PsychometricFitTests(SimpleTestCase):
+    def test_batch_matches_single_fits(self):
+        from din.management.commands.benchmark import simulate_sessions
+
+        test = SimpleNamespace(n_questions=24, starting_level=0, increment=2, min_level=-20, max_level=10)
+        levels, n_correct, _ = simulate_sessions(test, 40, np.random.default_rng(0))
+        batch_fits = fit_psychometric_batch(levels, n_correct)
+        single_fits = [fit_psychometric(lv.tolist(), nc.tolist()) for lv, nc in zip(levels, n_correct)]
+
+        for i, (params, x50) in enumerate(batch_fits):
+            self.assertTrue(np.isfinite(x50).all())
+            self.assertTrue((params[:, 2] < 0.5).all())
+            single = np.array([get_x50(*fits[i]) for fits in single_fits if fits[i] is not None])
+            delta = np.abs(single - x50[[fits[i] is not None for fits in single_fits]])
+            self.assertLess(np.median(delta), 0.5)
+
+    def test_failed_fits_are_nan(self):
+        levels = np.full((2, 24), np.nan)
+        levels[0] = np.repeat(np.arange(-12, 12, 2), 2)
+        (params, x50), _ = fit_psychometric_batch(levels, np.full((2, 24), 3))
+        self.assertTrue(np.isnan(params[1]).all() and np.isnan(x50[1]))
+
+
+class DatabaseLockedTests(TestCase):
+    def test_locked_write_is_503(self):
+        test = create_test(n_questions=4)
+        questionary = create_questionary()
+        url = f"/question/{questionary.pk}/{test.pk}/1/"
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        locked = mock.Mock(side_effect=OperationalError("database is locked"))
+        with mock.patch.object(TestSession, "record", locked), self.assertLogs("din.middleware", "ERROR"):
+            response = self.client.post(url, {"answer": "123"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response[LOCKED_HEADER], "1")
+
+    def test_other_errors_are_raised(self):
+        with mock.patch("din.views.get_question", side_effect=OperationalError("no such table")):
+            with self.assertRaises(OperationalError):
+                self.client.get(f"/question/1/{create_test().pk}/1/")
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.test = create_test(n_questions=4)
+        for _ in range(3):
+            questionary = create_questionary()
+            run_session(self.test, questionary)
+            TestSession.objects.get(questionary=questionary, test=self.test).summarize()
+
+    def snapshot(self, *args):
+        call_command("snapshot", "--path", self.path, *args, stdout=io.StringIO())
+        return load_snapshot(self.path, mmap_mode=None)
+
+    def test_deleted_sessions_are_dropped(self):
+        self.assertEqual(len(self.snapshot()["sessions"]["pk"]), 3)
+        deleted = SessionSummary.objects.order_by("pk").first()
+        deleted.questionary.delete()
+
+        sessions = self.snapshot()["sessions"]
+        self.assertEqual(sorted(sessions["pk"].tolist()), sorted(SessionSummary.objects.values_list("pk", flat=True)))
+        rebuilt = self.snapshot("--rebuild")["sessions"]
+        for name in ("pk", "questionary", "srt", "n_trials"):
+            np.testing.assert_array_equal(sessions[name], rebuilt[name])
+
+    def test_incomplete_snapshot_is_rebuilt(self):
+        self.snapshot()
+        os.remove(os.path.join(self.path, "sessions", "srt.npy"))
+        self.assertEqual(len(self.snapshot()["sessions"]["srt"]), 3)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def record(self, store: MetricsStore, n: int):
+        for _ in range(n):
+            store.record("question", "GET", 200, 0.01, 2, 0.001)
+        store.flush()
+
+    def get_count(self, store: MetricsStore) -> int:
+        return store.collect()["requests"]["question", "GET", "200"]
+
+    def test_exited_processes_are_merged(self):
+        exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                                capture_output=True, text=True, check=True)
+        pid = int(exited.stdout)
+        with mock.patch("din.metrics.os.getpid", return_value=pid):
+            self.record(MetricsStore(self.root), 3)
+
+        store = MetricsStore(self.root)
+        self.record(store, 2)
+        self.assertEqual(self.get_count(store), 5)
+        self.assertFalse((store.root / f"metrics-{pid}.json").exists())
+        self.assertEqual(self.get_count(store), 5)
+
+    def test_reused_pid_keeps_counts(self):
+        self.record(MetricsStore(self.root), 3)
+        # a new process with the same pid
+        store = MetricsStore(self.root)
+        self.record(store, 1)
+        self.assertEqual(self.get_count(store), 4)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.test = create_test(n_questions=4)
+        questionary = create_questionary()
+        run_session(self.test, questionary)
+        TestSession.objects.get(questionary=questionary, test=self.test).summarize()
+        self.staff = User.objects.create_user("staff", is_staff=True)
+        self.client.force_login(self.staff)
+
+    def test_invalid_date(self):
+        for date in ("2025-13-01", "yesterday"):
+            response = self.client.get("/export/sessions.csv", {"start": date})
+            self.assertEqual(response.status_code, 400, date)
+
+    def test_stream(self):
+        response = self.client.get("/export/responses.csv", {"start": "2000-01-01"})
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.is_async)
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), self.test.n_questions + 1)
+
+    def test_command_invalid_date(self):
+        for date in ("2024/01/05", "yesterday", "2025-13-01"):
+            with self.assertRaisesMessage(CommandError, "invalid date"):
+                call_command("export", "sessions", "--start", date, stdout=io.StringIO())
+
+    def test_command_date_filter(self):
+        output = io.StringIO()
+        with mock.patch("sys.stdout", io.TextIOWrapper(io.BytesIO())) as stdout:
+            call_command("export", "sessions", "--start", "2100-01-01", stdout=output)
+            stdout.flush()
+            rows = stdout.buffer.getvalue().decode().splitlines()
+        self.assertEqual(len(rows), 1)
+
+    async def test_stream_asgi(self):
+        await self.async_client.aforce_login(self.staff)
+        response = await self.async_client.get("/export/responses.csv")
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(content.decode().splitlines()), self.test.n_questions + 1)
+
+
+class MediaTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        os.makedirs(os.path.join(directory.name, "din_test", "snr-05"))
+        path = os.path.join(directory.name, "din_test", "snr-05", "123.wav")
+        with open(path, "wb") as f:
+            f.write(bytes(range(100)))
+        self.version = get_hash(path)
+        with open(os.path.join(directory.name, "results.csv"), "w") as f:
+            f.write("pk,age,srt\n")
+        settings = override_settings(MEDIA_ROOT=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def get(self, **headers):
+        return self.client.get(f"/media/din_test/snr-05/123.wav?v={self.version}", headers=headers)
+
+    def test_versioned_is_immutable(self):
+        for response, status in ((self.get(), 200), (self.get(Range="bytes=10-19"), 206)):
+            self.assertEqual(response.status_code, status)
+            self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(self.get(Range="bytes=10-19").content, bytes(range(10, 20)))
+
+    def test_only_stimuli_are_served(self):
+        for path in ("results.csv", "din_test/snr-05/results.csv", "din_test/../results.csv"):
+            self.assertEqual(self.client.get(f"/media/{path}").status_code, 404, path)
+
+    def test_unsatisfiable_range_is_not_cached(self):
+        response = self.get(Range="bytes=200-300")
+        self.assertEqual(response.status_code, 416)
+        self.assertFalse(response.has_header("Cache-Control"))
@@ -1,6 +1,8 @@
 from django.urls import path
 
 from . import views
+from .export import export_view
+from .metrics import metrics_view
 
 urlpatterns = [
     path("", views.index, name="index"),
@@ -8,8 +10,15 @@ urlpatterns = [
     path("setup/<int:qid>/", views.setup, name='setup'),
     path("test_question/<int:qid>/", views.test_question, name="test_question"),
     path("question/<int:qid>/<int:tid>/<int:question_number>/", views.question, name="question"),
+    path("api/question/<int:qid>/<int:tid>/<int:question_number>/", views.api_question, name="api_question"),
     path("results/", views.result_overview, name="result_overview"),
+    path("results/boxplot.<str:fmt>", views.result_overview_figure, name="result_overview_figure"),
     path("results/<int:qid>/", views.results, name="results"),
+    path("results/<int:qid>/<int:tid>.<str:fmt>", views.result_figure, name="result_figure"),
     path("test_complete", views.test_complete, name="test_complete"),
+    path("sw.js", views.service_worker, name="service_worker"),
+    path("metrics", metrics_view, name="metrics"),
+    path("export/<str:kind>.<str:fmt>", export_view, name="export"),
+    path("jobs/<int:pk>", views.job_status, name="job_status"),
 ]
   
\ No newline at end of file
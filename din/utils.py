@@ -2,26 +2,52 @@ import numpy as np
 from scipy.optimize import curve_fit
 from scipy.special import expit
 
-import matplotlib.pyplot as plt
+DIGIT_RANDOM_LVL = 1 / 10
+TRIPLET_RANDOM_LVL = 1 / 120
 
-def get_bins(levels, n_correct, lb=-20, ub=10):
+def get_bins_batch(levels, n_correct, lb=-20, ub=10):
+    """Bin the responses of many runs at once.
+
+    ``levels`` and ``n_correct`` have shape (n_sessions, n_trials); trials with
+    a NaN level are ignored, so runs of different lengths can be padded.
+    """
+    levels = np.atleast_2d(np.asarray(levels, dtype=float))
+    n_correct = np.atleast_2d(np.asarray(n_correct, dtype=float))
     bins = np.arange(lb, ub+2, step=2)
-    trials = np.zeros(len(bins))
-    bin_words_correct = np.zeros(len(bins))
-    bin_correct = np.zeros(len(bins))
-    mask = np.digitize(levels, bins, right=True)
-    for i, m in enumerate(mask):
-        trials[m] += 1
-        bin_correct[m] += n_correct[i] == 3
-        bin_words_correct[m] += n_correct[i]
+    n_sessions, n_bins = len(levels), len(bins)
+
+    valid = np.isfinite(levels)
+    mask = np.minimum(np.digitize(levels, bins, right=True), n_bins - 1)
+    index = (mask + n_bins * np.arange(n_sessions)[:, None])[valid]
+    n_correct = n_correct[valid]
+
+    def count(weights=None):
+        return np.bincount(
+            index, weights=weights, minlength=n_sessions * n_bins
+        ).reshape(n_sessions, n_bins).astype(float)
+
+    trials = count()
+    bin_correct = count(n_correct == 3)
+    bin_words_correct = count(n_correct)
     return bins, bin_correct, bin_words_correct, trials
 
 
+def get_bins(levels, n_correct, lb=-20, ub=10):
+    bins, bin_correct, bin_words_correct, trials = get_bins_batch(
+        levels, n_correct, lb, ub
+    )
+    return bins, bin_correct[0], bin_words_correct[0], trials[0]
+
+
 def logistic(x, alpha, beta, gamma, lambda_):
     return gamma + (1 - gamma - lambda_) * expit((x - alpha) / beta)
 
 
-def fit_curve(bins, bin_correct, trials, random_lvl):
+def get_srt(levels, next_level, n_last=20):
+    return np.mean(np.r_[levels[-n_last:], next_level])
+
+
+def get_psycho(bins, bin_correct, trials, random_lvl):
     psycho = np.zeros(len(bins))
     mask = np.nonzero(trials)
     psycho[mask] = bin_correct[mask] / trials[mask]
@@ -30,7 +56,10 @@ def fit_curve(bins, bin_correct, trials, random_lvl):
     psycho[ma:] = psycho[ma]
     mb = mask[0][0]
     psycho[:mb] = min(random_lvl, psycho[mb])
+    return psycho, mask
+
 
+def fit_logistic(bins, psycho):
     (alpha, beta, gamma, lambda_), *_ = curve_fit(
         lambda x, alpha, beta, gamma, lambda_: logistic(x, alpha, beta, gamma, lambda_),
         bins,
@@ -41,12 +70,198 @@ def fit_curve(bins, bin_correct, trials, random_lvl):
             [-0.0, 5.0, 1.0, 0.1],
         ),
     )
-    x50 = alpha + beta * np.log((0.5 - gamma) / (0.5 - lambda_))
+    return alpha, beta, gamma, lambda_
+
+
+def get_x50(alpha, beta, gamma, lambda_):
+    return alpha + beta * np.log((0.5 - gamma) / (0.5 - lambda_))
+
+
+def fit_curve(bins, bin_correct, trials, random_lvl, params=None):
+    psycho, mask = get_psycho(bins, bin_correct, trials, random_lvl)
+    if params is None:
+        params = fit_logistic(bins, psycho)
+
+    x50 = get_x50(*params)
     x_fit = np.linspace(-20, 10.0, 200)
-    y_fit = logistic(x_fit, alpha, beta, gamma, lambda_)
+    y_fit = logistic(x_fit, *params)
     return x50, x_fit, y_fit, bins[mask], psycho[mask]
 
 
+def fit_psychometric(levels, n_correct):
+    """Fit the digit and triplet psychometric curves of a single run.
+
+    Returns the (alpha, beta, gamma, lambda) parameters of both fits, or None
+    for a fit that did not converge.
+    """
+    bins, bin_correct, bin_words_correct, trials = get_bins(levels, n_correct)
+    fits = []
+    for bin_correct_, trials_, rnd_lvl in (
+        (bin_words_correct, trials * 3, DIGIT_RANDOM_LVL),
+        (bin_correct, trials, TRIPLET_RANDOM_LVL),
+    ):
+        psycho, _ = get_psycho(bins, bin_correct_, trials_, rnd_lvl)
+        try:
+            fits.append(tuple(float(p) for p in fit_logistic(bins, psycho)))
+        except (RuntimeError, ValueError):
+            fits.append(None)
+    return tuple(fits)
+
+
+LOGISTIC_BOUNDS = (
+    (-30.0, 0.0),
+    (0.001, 5.0),
+    (1e-10, 1.0),
+    (0.0, 0.1),
+)
+# gamma is bounded to this multiple of the random guess level in batch fits,
+# which keeps it below 0.5 so that the x50 exists
+GUESS_RANGE = 2
+# starting (alpha offset from the mean presented level in dB, beta, lambda) of
+# a batch fit, shallow to almost step-like curves around the presented levels
+BATCH_STARTS = (
+    (0.0, 1.0, 0.01),
+    (-4.0, 1.0, 0.01),
+    (4.0, 1.0, 0.01),
+    (-2.0, 0.3, 0.05),
+    (2.0, 0.3, 0.05),
+    (-1.0, 0.1, 0.05),
+    (1.0, 0.1, 0.05),
+)
+
+
+def get_logistic_bounds(random_lvl: float):
+    """The (lower, upper) bounds of a batch fit with the given random guess level."""
+    lower, upper = np.array(LOGISTIC_BOUNDS).T
+    upper[2] = GUESS_RANGE * random_lvl
+    return lower, upper
+
+
+def _logistic_terms(params, bins):
+    alpha, beta, gamma, lambda_ = params.T[..., None]
+    s = expit((bins - alpha) / beta)
+    scale = 1 - gamma - lambda_
+    p = np.clip(gamma + scale * s, 1e-9, 1 - 1e-9)
+    ds = scale * s * (1 - s)
+    jac = np.stack([-ds / beta, -ds * (bins - alpha) / beta ** 2, 1 - s, -s], axis=-1)
+    return p, jac
+
+
+def _binomial_nll(p, successes, trials):
+    return -(successes * np.log(p) + (trials - successes) * np.log1p(-p)).sum(axis=1)
+
+
+def fit_logistic_batch(bins, successes, trials, p0, bounds=None, max_iter=200, tol=1e-9):
+    """Binomial maximum likelihood fit of the logistic of many runs at once.
+
+    ``successes`` and ``trials`` have shape (n_sessions, n_bins), ``p0`` holds
+    the (n_sessions, 4) starting parameters, e.g. the fits of a previous run.
+    Every run is fitted independently with projected, damped Fisher scoring on
+    the analytic gradient, and all runs are stepped together.
+    Returns the (n_sessions, 4) fitted alpha, beta, gamma and lambda, their
+    negative log likelihood and whether each fit converged within ``max_iter``.
+    """
+    lower, upper = np.array(LOGISTIC_BOUNDS).T if bounds is None else bounds
+    params = np.clip(np.array(p0, dtype=float), lower, upper)
+    n_sessions = len(params)
+
+    p, jac = _logistic_terms(params, bins)
+    nll = _binomial_nll(p, successes, trials)
+    damping = np.full(n_sessions, 1e-3)
+    active = np.arange(n_sessions)
+    eye = np.eye(4)
+
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        p_, jac_, k, n = p[active], jac[active], successes[active], trials[active]
+        params_ = params[active]
+
+        score = np.einsum("nb,nbi->ni", (k - n * p_) / (p_ * (1 - p_)), jac_)
+        info = np.einsum("nb,nbi,nbj->nij", n / (p_ * (1 - p_)), jac_, jac_)
+
+        # Parameters at a bound that the score pushes outwards are held fixed
+        fixed = ((params_ <= lower) & (score < 0)) | ((params_ >= upper) & (score > 0))
+        free = ~fixed
+        info *= free[:, :, None] & free[:, None, :]
+        diag = np.einsum("nii->ni", info)
+        info += (damping[active, None] * diag + 1e-9 + fixed)[:, None, :] * eye
+        step = np.linalg.solve(info, (score * free)[..., None])[..., 0]
+
+        candidate = np.clip(params_ + step, lower, upper)
+        p_c, jac_c = _logistic_terms(candidate, bins)
+        nll_c = _binomial_nll(p_c, k, n)
+
+        better = nll_c < nll[active]
+        improved = active[better]
+        decrease = nll[improved] - nll_c[better]
+        params[improved], p[improved], jac[improved] = candidate[better], p_c[better], jac_c[better]
+        nll[improved] = nll_c[better]
+        damping[improved] /= 10
+        damping[active[~better]] *= 10
+
+        converged = np.zeros(len(active), dtype=bool)
+        converged[better] = decrease <= tol * (1 + nll_c[better])
+        converged |= damping[active] > 1e10
+        active = active[~converged]
+
+    converged = np.ones(n_sessions, dtype=bool)
+    converged[active] = False
+    return params, nll, converged
+
+
+def fit_psychometric_batch(levels, n_correct, p0=(None, None)):
+    """Fit the digit and triplet psychometric curves of many runs at once.
+
+    Returns a (params, x50) tuple for the digit and triplet fits, with params
+    of shape (n_sessions, 4). Every run is fitted from the ``BATCH_STARTS``
+    around its mean presented level, and from its previous fit when given in
+    p0, and the best fit is kept. Like ``fit_psychometric`` returns None, the
+    params and x50 of a run whose fit did not converge or has no x50 are NaN.
+    """
+    bins, bin_correct, bin_words_correct, trials = get_bins_batch(levels, n_correct)
+    levels = np.atleast_2d(np.asarray(levels, dtype=float))
+    presented = np.isfinite(levels)
+    with np.errstate(invalid="ignore"):
+        # NaN for a run without any level, whose fit fails
+        mean_level = np.where(presented, levels, 0).sum(axis=1) / presented.sum(axis=1)
+    n_sessions = len(mean_level)
+
+    fits = []
+    for successes, trials_, rnd_lvl, p0_ in (
+        (bin_words_correct, trials * 3, DIGIT_RANDOM_LVL, p0[0]),
+        (bin_correct, trials, TRIPLET_RANDOM_LVL, p0[1]),
+    ):
+        starts = []
+        for offset, beta, lambda_ in BATCH_STARTS:
+            start = np.tile([0.0, beta, rnd_lvl, lambda_], (n_sessions, 1))
+            start[:, 0] = mean_level + offset
+            starts.append(start)
+        if p0_ is not None:
+            starts.append(np.asarray(p0_, dtype=float))
+
+        # all starts are fitted together, as extra runs
+        n_starts = len(starts)
+        params, nll, converged = fit_logistic_batch(
+            bins,
+            np.tile(successes, (n_starts, 1)),
+            np.tile(trials_, (n_starts, 1)),
+            np.concatenate(starts),
+            get_logistic_bounds(rnd_lvl),
+        )
+        nll = np.where(converged, nll, np.inf).reshape(n_starts, n_sessions)
+        best = np.argmin(nll, axis=0)
+        rows = best * n_sessions + np.arange(n_sessions)
+        params = params[rows]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x50 = get_x50(*params.T)
+        failed = ~converged[rows] | ~np.isfinite(x50)
+        params[failed], x50[failed] = np.nan, np.nan
+        fits.append((params, x50))
+    return tuple(fits)
+
+
 def plot_test_results(levels, srt, ax):
     x = np.arange(1, 1 + len(levels))
     ax.plot(x, levels, linestyle="dashed", marker="*")
@@ -65,12 +280,12 @@ def plot_test_results(levels, srt, ax):
     ax.grid()
 
 
-def plot_psychometric(levels, n_correct, ax1, ax2):
+def plot_psychometric(levels, n_correct, ax1, ax2, fits=(None, None)):
     bins, bin_correct, bin_words_correct, trials = get_bins(levels, n_correct)
 
-    def inner(ax, bin_correct_, trials_, nh_db, ci_db, rnd_lvl):
+    def inner(ax, bin_correct_, trials_, nh_db, ci_db, rnd_lvl, params):
         x50, x_fit, y_fit, mbins, mpsycho = fit_curve(
-            bins, bin_correct_, trials_, rnd_lvl
+            bins, bin_correct_, trials_, rnd_lvl, params
         )
         ax.plot(mbins, mpsycho, linestyle="dashed", marker="*")
         ax.plot(x_fit, y_fit, color="magenta", alpha=0.5)
@@ -105,20 +320,23 @@ def plot_psychometric(levels, n_correct, ax1, ax2):
         ax.legend(fontsize=7, loc="lower right")
         ax.set_ylim(0, 1.05)
 
-    inner(ax1, bin_words_correct, trials * 3, -11, -6, 1 / 10)
-    inner(ax2, bin_correct, trials, -8, -3, 1 / 120)
+    digit_fit, triplet_fit = fits
+    inner(ax1, bin_words_correct, trials * 3, -11, -6, DIGIT_RANDOM_LVL, digit_fit)
+    inner(ax2, bin_correct, trials, -8, -3, TRIPLET_RANDOM_LVL, triplet_fit)
 
     ax1.set_ylabel("percentage correct (digit)")
     ax2.set_ylabel("percentage correct (triplet)")
 
 
-def get_plots(levels, n_correct, srt):
+def get_plots(levels, n_correct, srt, fits=(None, None)):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(figsize=(15, 4))
     ax1 = fig.add_subplot(131)
     ax2 = fig.add_subplot(132) 
     ax3 = fig.add_subplot(133, sharey=ax2)    
     plot_test_results(levels, srt, ax1)
-    plot_psychometric(levels, n_correct, ax2, ax3)
+    plot_psychometric(levels, n_correct, ax2, ax3, fits)
     plt.tight_layout()
     return fig    
     
@@ -1,19 +1,29 @@
 import random
 import io
-import urllib
-import base64
+from collections import defaultdict
 
-import numpy as np
-import matplotlib
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
+from asgiref.sync import sync_to_async
 
 from django import forms
-from django.shortcuts import render, redirect
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404, HttpResponse, JsonResponse, QueryDict
+from django.shortcuts import render, redirect, get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.urls import reverse
+from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 
-from din.models import Questionary, Test, Response, Stimulus
-from din.utils import plot_psychometric, plot_test_results, get_plots
+from din import jobs
+from din.models import Questionary, Test, Response, TestSession, SessionSummary, Job
+from din.figures import CONTENT_TYPES, figure_cache, get_key, get_pyplot
+from din.catalog import catalog
+from din.db import retry_on_locked
+
+# template loading reads files, async views render on the sync thread
+arender = sync_to_async(render)
+
 
 def context_processor(request):
     keypad_rows = [
@@ -57,182 +67,427 @@ def index(request):
     return render(request, "index.html")
 
 
-def questionary(request):
+async def questionary(request):
     if request.method == "POST":
         form = QuestionaryForm(request.POST)
         if form.is_valid():
-            new_instance = form.save()
+            new_instance = await retry_on_locked(Questionary.objects.acreate)(**form.cleaned_data)
             return redirect("setup", qid=new_instance.pk)
 
-        return render(request, "questionary.html", {"form": form})
+        return await arender(request, "questionary.html", {"form": form})
 
     form = QuestionaryForm()
-    return render(request, "questionary.html", {"form": form})
+    return await arender(request, "questionary.html", {"form": form})
 
 
 def setup(request, qid):
     return render(request, "setup.html", {"qid": qid})
 
 
-def test_question(request, qid):
+async def test_question(request, qid):
     tests = Test.objects.filter(active=True)
     if request.method == "POST":
-        random_test = random.choice(tests.values_list('pk', flat=True))
+        random_test = random.choice([pk async for pk in tests.values_list('pk', flat=True)])
         return redirect("question", qid, random_test, 1)
 
-    return render(request, "test_question.html", {"n_tests": tests.count()})
+    return await arender(request, "test_question.html", {"n_tests": await tests.acount()})
 
 def get_available_tests(questionary):
-    responses = Response.objects.filter(questionary=questionary)
-    test_already_done = set(responses.values_list('test_id', flat=True).distinct())
-    available_tests = set(Test.objects.filter(active=True).values_list('pk', flat=True))
-    return list(available_tests - test_already_done)
+    tests_started = TestSession.objects.filter(
+        questionary=questionary).values_list('test_id', flat=True)
+    available_tests = Test.objects.filter(active=True).exclude(pk__in=tests_started)
+    return list(available_tests.values_list('pk', flat=True))
 
 
-def get_next_url(request, test, questionary):
-    parts = request.path.split("/")
-    next_q = int(parts[-2]) + 1
+def get_next_question(test, qid, question_number):
+    next_q = question_number + 1
     
     if next_q > test.n_questions:
-        next_tests = get_available_tests(questionary)
+        next_tests = get_available_tests(qid)
         if len(next_tests) == 0:
-            return "/test_complete"
-        parts[-3] = str(random.choice(next_tests))
-        parts[-2] = str(1)
-    else:
-        parts[-2] = str(next_q)
-    
-    return "/".join(parts)
-    
+            return None
+        return random.choice(next_tests), 1
+    return test.pk, next_q
+
+
+def get_next_url(test, qid, question_number):
+    next_question = get_next_question(test, qid, question_number)
+    if next_question is None:
+        return reverse('test_complete')
+    return reverse('question', args=(qid, *next_question))
+
+
+def save_stimulus(session, response, stimuli):
+    with transaction.atomic():
+        response.save(update_fields=['stimulus'])
+        session.prefetch(response, stimuli)
+
+
+@retry_on_locked
+def save_answer(test, session, response, answer):
+    """Store the first answer to a question and advance the session.
+
+    Every attempt starts from the rows in the database, so a retry after a
+    lock error does not see the changes the failed attempt made in memory.
+    """
+    with transaction.atomic():
+        stored = Response.objects.filter(pk=response.pk).values_list("answer", flat=True).get()
+        if stored:
+            # answered by another request in the meantime
+            response.answer = stored
+            return
+        session.refresh_from_db(fields=["index", "level", "last_correct", "seen"])
+        response.answer = answer
+        response.save(update_fields=['answer'])
+        session.record(response)
+        if response.index == test.n_questions:
+            queue_summary(response.questionary_id, test.pk)
 
-def question(request, qid, tid, question_number):
-    test = Test.objects.get(pk=tid)
-    questionary = Questionary.objects.get(pk=qid)
+
+@retry_on_locked
+def get_question(qid, test, question_number, session=None):
+    session = session or test.get_session(qid)
     
-    response, _ = Response.objects.get_or_create(
+    response, _ = Response.objects.select_related('stimulus__test').get_or_create(
         index=question_number,
-        questionary=questionary,
+        questionary_id=qid,
         test=test, 
     )
     
-    available_tests = get_available_tests(questionary)
+    stimuli = catalog.get(test)
     if not response.stimulus:
-        stims = Stimulus.objects.filter(test=test, level=response.get_level())
-        response.stimulus = random.choice(stims)
-        response.save()
-    
-    if request.method == "POST":
-        user_answer = request.POST.get("answer").strip()
-        if not response.answered:
-            response.answer = user_answer
-            response.save()
-            
-        next_q = int(question_number) + 1
-        if next_q > test.n_questions:
-            if len(available_tests) == 0:
-                return redirect('test_complete')
-            next_test = random.choice(available_tests)
-            return redirect('question', qid, next_test, 1)
-        return redirect('question', qid, tid, next_q)
-    
+        response.stimulus = session.next_stimulus(response, stimuli)
+        save_stimulus(session, response, stimuli)
+    return session, response, stimuli
+
+
+def answer_question(test, session, response, answer):
+    if not response.answered:
+        save_answer(test, session, response, answer)
+
+
+def get_prefetch(session, response, stimuli):
+    if response.answered:
+        return []
+    candidates = session.get_candidates(response.index + 1).items()
+    prefetch = [stimuli.get(level, pk) for level, pk in candidates]
+    return [stimulus.sources for stimulus in prefetch if stimulus is not None]
+
+
+def get_question_context(qid, test, session, response, stimuli):
     n_tests = Test.objects.filter(active=True).count()
-    nth_test = Response.objects.filter(
-        questionary=questionary).values_list(
-            'test_id', flat=True
-    ).distinct().count()
-    return render(request, "question.html", {
+    nth_test = TestSession.objects.filter(questionary_id=qid).count()
+    return {
+        'prefetch': get_prefetch(session, response, stimuli),
         'response': response,
-        'current': question_number,
+        'current': response.index,
         'total': test.n_questions,
         'nth_test': nth_test,
         'total_tests': n_tests,
-        'next_url': get_next_url(request, test, questionary),
-    })
+    }
+
+
+def render_question(request, qid, test, session, response, stimuli):
+    context = get_question_context(qid, test, session, response, stimuli)
+    context['next_url'] = get_next_url(test, qid, response.index) if response.answered else None
+    return render(request, "question.html", context)
+
+
+async def question(request, qid, tid, question_number):
+    # The helpers are shared with the sync api views and run on Django's sync
+    # thread, which keeps the database work and the blocking file reads of
+    # media hashing and template rendering out of the event loop
+    test = await Test.objects.aget(pk=tid)
+    session, response, stimuli = await sync_to_async(get_question)(qid, test, question_number)
+    
+    if request.method == "POST":
+        await sync_to_async(answer_question)(test, session, response, request.POST.get("answer").strip())
+        return redirect(await sync_to_async(get_next_url)(test, qid, question_number))
+    
+    return await sync_to_async(render_question)(request, qid, test, session, response, stimuli)
+
+
+def question_json(qid, test, session, response, stimuli):
+    context = get_question_context(qid, test, session, response, stimuli)
+    return {
+        'url': reverse('question', args=(qid, test.pk, response.index)),
+        'api_url': reverse('api_question', args=(qid, test.pk, response.index)),
+        'answered': response.answered,
+        'sources': response.stimulus.sources,
+        **{key: context[key] for key in ('prefetch', 'current', 'total', 'nth_test', 'total_tests')},
+    }
+
+
+@require_http_methods(["GET", "POST"])
+def api_question(request, qid, tid, question_number):
+    """Run a test session without page reloads.
+
+    GET returns the stimulus and progress of a question. POST scores the
+    ``answer`` and returns the next question in the same response, or the url
+    to continue at when all tests are done.
+    """
+    test = get_object_or_404(Test, pk=tid)
+    session, response, stimuli = get_question(qid, test, question_number)
+    if request.method == "GET":
+        return JsonResponse(question_json(qid, test, session, response, stimuli))
+    
+    answer = request.POST.get("answer", "").strip()
+    if not (len(answer) == 3 and answer.isdigit()):
+        return JsonResponse({'error': "answer must be three digits"}, status=400)
+    answer_question(test, session, response, answer)
     
-def test_complete(request):
-    return render(request, "test_complete.html")
+    result = {
+        'correct': response.correct,
+        'n_correct': response.n_correct,
+        'next': None,
+        'complete_url': None,
+    }
+    next_question = get_next_question(test, qid, question_number)
+    if next_question is None:
+        result['complete_url'] = reverse('test_complete')
+    else:
+        if next_question[0] == test.pk:
+            next_test, next_session = test, session
+        else:
+            next_test, next_session = Test.objects.get(pk=next_question[0]), None
+        next_state = get_question(qid, next_test, next_question[1], next_session)
+        result['next'] = question_json(qid, next_test, *next_state)
+    return JsonResponse(result)
+
+    
+async def test_complete(request):
+    return await arender(request, "test_complete.html")
 
 
-def plot_to_data(fig) -> str:
+def service_worker(request):
+    response = render(request, "sw.js", {"media_url": settings.MEDIA_URL},
+                      content_type="application/javascript")
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def plot_to_data(fig, fmt: str = "png") -> bytes:
     buf = io.BytesIO()
-    fig.savefig(buf, format='png',  transparent=True)
-    buf.seek(0)
-    string = base64.b64encode(buf.read())
-    uri = urllib.parse.quote(string)
-    return uri
-
-def get_boxplot_snr(tests: Test) -> str:
-    with_data = []
-    snr_data = []
-    for test in tests:
-        snrs = test.get_snrs()
-        if len(snrs) != 0:
-            with_data.append(test)
-            snr_data.append(snrs)
-    if len(snr_data) == 0:
-        return ""
+    fig.savefig(buf, format=fmt,  transparent=True)
+    get_pyplot().close(fig)
+    return buf.getvalue()
+
+
+def figure_response(request, key: str, fmt: str, queue) -> HttpResponse:
+    """Serve a rendered figure, or queue it with ``queue()`` and answer 202."""
+    if fmt not in CONTENT_TYPES:
+        raise Http404(f"Unknown figure format {fmt}")
+    
+    etag = f'"{key}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        data = figure_cache.get(key, fmt)
+        if data is None:
+            job = queue()
+            data = figure_cache.get(key, fmt)
+        if data is None:
+            response = JsonResponse(get_job_status(job), status=202)
+            response["Retry-After"] = "2"
+            patch_cache_control(response, no_store=True)
+            return response
+        response = HttpResponse(data, content_type=CONTENT_TYPES[fmt])
+    response["ETag"] = etag
+    if request.GET.get("v") == key:
+        patch_cache_control(response, private=True, max_age=365 * 24 * 3600, immutable=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def get_figure_url(figure: dict) -> str:
+    """The url of a figure given as its url name, args, query and key."""
+    query = QueryDict(mutable=True)
+    query.update(figure.get("query", {}))
+    query["v"] = figure["key"]
+    return f"{reverse(figure['name'], args=figure['args'])}?{query.urlencode()}"
+
+
+def get_figure(figure: dict, queue) -> dict:
+    """The url of a rendered figure, or the status url of the job rendering it."""
+    fmt = figure["args"][-1]
+    if not figure_cache.has(figure["key"], fmt):
+        job = queue()
+        if not figure_cache.has(figure["key"], fmt):
+            return {"url": None, "job": reverse("job_status", args=(job.pk,))}
+    return {"url": get_figure_url(figure), "job": None}
+
+
+def get_boxplot_data(tests: list[Test]):
+    snrs = defaultdict(list)
+    summaries = SessionSummary.objects.filter(test__in=tests).values_list("test", "srt")
+    for test_id, srt in summaries:
+        snrs[test_id].append(srt)
     
-    fig, ax = plt.subplots(figsize=(12, 4))
+    with_data = [test for test in tests if len(snrs[test.pk]) != 0]
+    labels = [f"{t.name}_{t.audio_generator}" for t in with_data]
+    return labels, [snrs[test.pk] for test in with_data]
+
+
+def get_boxplot_snr(labels: list[str], snr_data: list[list[float]], fmt: str = "png") -> bytes:
+    fig, ax = get_pyplot().subplots(figsize=(12, 4))
     ax.violinplot(
         snr_data,
         showmedians=True,        
     )
-    ax.set_xticks([y + 1 for y in range(len(with_data))],
-                  labels=[f"{t.name}_{t.audio_generator}" for t in with_data])
+    ax.set_xticks([y + 1 for y in range(len(labels))], labels=labels)
     ax.grid()
-    return plot_to_data(fig)
-    
+    return plot_to_data(fig, fmt)
+
+
+def get_boxplot_figure(labels: list[str], snr_data: list[list[float]], active: bool, fmt: str = "png") -> dict:
+    return {
+        "name": "result_overview_figure",
+        "args": [fmt],
+        "query": {"active": "1"} if active else {},
+        "key": get_key("boxplot", labels, snr_data),
+    }
+
+
+def queue_boxplot(figure: dict, active: bool):
+    return lambda: jobs.enqueue(
+        "boxplot", f"figure:{figure['key']}.{figure['args'][-1]}", active=active, fmt=figure["args"][-1])
+
+
+def get_overview_tests(active: bool):
+    tests = Test.objects.all().order_by("-pk")
+    if active:
+        tests = tests.filter(active=True)    
+    return tests
 
 
 @login_required
 def result_overview(request):
     questionaries = Questionary.objects.all() 
-    tests = Test.objects.all().order_by("-pk")
+    active = request.GET.get('active') is not None
+    tests = get_overview_tests(active)
     
-    active_param = request.GET.get('active')
-    if active_param is not None:
-        tests = tests.filter(active=True)    
+    if active:
         active_q = Response.objects.filter(
             test__in=tests).values_list("questionary", flat=True).distinct()
         questionaries = questionaries.filter(pk__in=active_q)
     
+    tests = list(tests.with_stats())
+    labels, snr_data = get_boxplot_data(tests)
+    boxplot = None
+    if len(labels) != 0:
+        figure = get_boxplot_figure(labels, snr_data, active)
+        boxplot = get_figure(figure, queue_boxplot(figure, active))
+    
     return render(request, "results_overview.html", context={
         "questionaries": questionaries,
         "tests": tests,
-        "boxplot": get_boxplot_snr(tests)
+        "boxplot": boxplot,
     })
 
+
 @login_required
-def results(request, qid):
-    questionary = Questionary.objects.get(pk=qid)
-    responses = questionary.response_set.filter()
-    tests = sorted(responses.values_list("test", flat=True).distinct())
+def result_overview_figure(request, fmt):
+    active = request.GET.get('active') is not None
+    labels, snr_data = get_boxplot_data(list(get_overview_tests(active)))
+    if len(labels) == 0:
+        raise Http404("No results yet")
     
+    figure = get_boxplot_figure(labels, snr_data, active, fmt)
+    return figure_response(request, figure["key"], fmt, queue_boxplot(figure, active))
+
+
+def get_result_key(summary: SessionSummary) -> str:
+    return get_key(
+        "result", summary.levels, summary.n_correct, summary.srt, summary.fits
+    )
+
+
+def get_result_figure(summary: SessionSummary, fmt: str = "png") -> dict:
+    return {
+        "name": "result_figure",
+        "args": [summary.questionary_id, summary.test_id, fmt],
+        "key": get_result_key(summary),
+    }
+
+
+def render_result(summary: SessionSummary, fmt: str = "png") -> bytes:
+    # scipy and matplotlib are only imported by the processes that plot
+    get_pyplot()
+    from din.utils import get_plots
+    fig = get_plots(summary.levels, summary.n_correct, summary.srt, summary.fits)
+    return plot_to_data(fig, fmt)
+
+
+def queue_summary(qid: int, tid: int):
+    return jobs.enqueue("summary", f"summary:{qid}:{tid}", questionary=qid, test=tid)
+
+
+def queue_result_figure(summary: SessionSummary, fmt: str = "png"):
+    return lambda: jobs.enqueue(
+        "result_figure", f"figure:{get_result_key(summary)}.{fmt}",
+        questionary=summary.questionary_id, test=summary.test_id, fmt=fmt,
+    )
+
+
+@login_required
+def results(request, qid):
+    questionary = get_object_or_404(Questionary, pk=qid)
+    # completed sessions are summarized in the background, pick up the ones not done yet
+    summarized = questionary.sessionsummary_set.values_list("test", flat=True)
+    completed = TestSession.objects.filter(
+        questionary=questionary, index__gte=F("test__n_questions")
+    ).exclude(test__in=summarized).select_related("test")
+    pending = {session.test: queue_summary(qid, session.test_id) for session in completed}
+
+    summaries = questionary.sessionsummary_set.select_related("test").order_by("test")
     test_results = []
-    for test in tests:
-        test = Test.objects.get(pk=test)
-        test_responses = responses.filter(test=test).order_by("index")
-        completed = test_responses.count() == test.n_questions
-        if not completed:
-            continue
-        
-        levels = np.array([x.stimulus.level for x in test_responses])
-        n_correct = np.array([x.n_correct for x in test_responses])
-        srt_levels = np.r_[
-            levels[-20:], Response.get_next_level(test_responses.last())
-        ]       
-        srt = np.mean(srt_levels)
-        
-        fig = get_plots(levels, n_correct, srt)
+    for summary in summaries:
+        figure = get_figure(get_result_figure(summary), queue_result_figure(summary))
         test_results.append(
             {
-                "test": test,
-                "srt": srt,
-                "result_plot": plot_to_data(fig),
+                "test": summary.test,
+                "srt": summary.srt,
+                "result_plot": figure["url"],
+                "job": figure["job"],
             }
         )
+    summarized = {result["test"].pk for result in test_results}
+    for test, job in pending.items():
+        if test.pk not in summarized:
+            test_results.append({
+                "test": test,
+                "srt": None,
+                "result_plot": None,
+                "job": reverse("job_status", args=(job.pk,)),
+            })
         
     return render(request, "results.html", context={
         "test_results": test_results,
         "questionary": questionary
     })
+
+
+@login_required
+def result_figure(request, qid, tid, fmt):
+    summary = get_object_or_404(SessionSummary, questionary_id=qid, test_id=tid)
+    return figure_response(request, get_result_key(summary), fmt, queue_result_figure(summary, fmt))
+
+
+def get_job_status(job: Job) -> dict:
+    status = {"status": job.status}
+    if job.status == Job.DONE:
+        status["srt"] = job.result.get("srt")
+        if "figure" in job.result:
+            status["url"] = get_figure_url(job.result["figure"])
+    elif job.status == Job.FAILED:
+        status["error"] = job.error.strip().splitlines()[-1] if job.error else ""
+    return status
+
+
+@login_required
+def job_status(request, pk):
+    """The status of a job, with the url of its figure once done, for the result pages to poll."""
+    job = get_object_or_404(Job, pk=pk)
+    response = JsonResponse(get_job_status(job))
+    patch_cache_control(response, no_store=True)
+    return response
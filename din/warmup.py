@@ -0,0 +1,52 @@
+import sys
+
+# The modules whose import dominates the startup time and memory of a worker
+HEAVY_MODULES = ("numpy", "scipy", "matplotlib", "pandas", "statsmodels", "pyarrow")
+
+
+def warm_up(plotting: bool = False):
+    """Load what the first requests of a worker would otherwise load.
+
+    Imports the views through the url patterns and fills the stimulus catalog
+    of the active tests. With ``plotting``, scipy and matplotlib are imported
+    as well. Database connections are closed afterwards, so a process can
+    fork after warming up without sharing them.
+    """
+    from django.db import connections
+    from django.urls import get_resolver
+
+    from din.catalog import catalog
+    from din.models import Test
+
+    get_resolver().url_patterns
+    for test in Test.objects.filter(active=True):
+        catalog.get(test)
+    if plotting:
+        from din.figures import get_pyplot
+        import din.utils  # noqa: F401
+        get_pyplot()
+    connections.close_all()
+
+
+def get_memory(pid: int = None) -> dict:
+    """Resident, proportional and unique set size of a process in MiB.
+
+    Forked workers share the pages of the master, which the rss counts for
+    every worker; pss splits shared pages between the processes and uss is
+    what the process alone holds. pss and uss are only available on Linux.
+    """
+    import psutil
+
+    process = psutil.Process(pid)
+    try:
+        info = process.memory_full_info()
+    except psutil.AccessDenied:
+        info = process.memory_info()
+    return {
+        name: round(getattr(info, name) / 2 ** 20, 1)
+        for name in ("rss", "pss", "uss") if hasattr(info, name)
+    }
+
+
+def get_heavy_modules() -> list[str]:
+    return [name for name in HEAVY_MODULES if name in sys.modules]
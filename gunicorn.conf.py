@@ -0,0 +1,45 @@
+"""Gunicorn configuration, read from the working directory:
+
+    gunicorn settings.wsgi:application
+    gunicorn settings.asgi:application -k uvicorn.workers.UvicornWorker
+
+The application is loaded once in the master (``preload_app``) and warmed up
+before the workers are forked, so the workers share its memory copy-on-write
+and serve their first request without importing anything. Set
+``DIN_PRELOAD_PLOTTING=1`` to also load scipy and matplotlib in the master,
+which makes the first staff figure of every worker fast at the cost of ~70 MiB
+in the master. Settings can be overridden on the command line as usual.
+"""
+import gc
+import os
+
+bind = os.environ.get("DIN_BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("DIN_WORKERS", 2))
+threads = int(os.environ.get("DIN_THREADS", 1))
+preload_app = True
+max_requests = int(os.environ.get("DIN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+PRELOAD_PLOTTING = os.environ.get("DIN_PRELOAD_PLOTTING", "0") == "1"
+
+
+def when_ready(server):
+    from din.warmup import get_heavy_modules, get_memory, warm_up
+
+    warm_up(plotting=PRELOAD_PLOTTING)
+    # keep the garbage collector from touching, and so copying, the preloaded objects
+    gc.freeze()
+    server.log.info("warmed up master %s, loaded %s", get_memory(), ", ".join(get_heavy_modules()))
+
+
+def post_worker_init(worker):
+    from din.warmup import get_memory
+
+    worker.log.info("worker %s ready, %s", worker.pid, get_memory())
+
+
+def child_exit(server, worker):
+    from din.metrics import metrics
+
+    # keep the counts of the worker, before another process gets its pid
+    metrics.merge(worker.pid)
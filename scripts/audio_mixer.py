@@ -1,5 +1,7 @@
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 import librosa
 import soundfile as sf
@@ -41,6 +43,67 @@ def mix_v2(stim, noise, snr):
     stim_scaled = stim * gain
     mixed = noise + stim_scaled
     return mixed    
+
+
+def mix_v2_batch(stim, noise_segments, snrs):
+    """mix_v2 for all rows of noise_segments at once, one snr per row."""
+    db_stim = rms_db(stim[np.nonzero(stim)])
+    db_noise = rms_db(noise_segments, axis=1)
+    db_tgt = db_noise + np.asarray(snrs, dtype=db_noise.dtype)
+    gain = 10 ** ((db_tgt - db_stim) / 20)
+    return noise_segments + stim * gain[:, None]
+
+
+def pad_silence(stim, sr, silence):
+    return np.r_[
+        np.zeros(int(sr * silence)),
+        stim,
+        np.zeros(int(sr * silence)),
+    ]
+
+
+def draw_offsets(stim_files, n_noise, snrs, silence):
+    """Draw the noise offsets of every (file, snr) in the sequential order.
+    
+    This reproduces the random stream of mixing the files one after another
+    after seeding, so the output does not depend on the number of jobs.
+    """
+    offsets = []
+    for stim_file in stim_files:
+        info = sf.info(stim_file)
+        n_stim = info.frames + 2 * int(info.samplerate * silence)
+        offsets.append([np.random.randint(0, n_noise - n_stim) for _ in snrs])
+    return np.array(offsets)
+
+
+_noise = _shm = None
+
+def _attach_noise(name, shape, dtype):
+    global _noise, _shm
+    _shm = shared_memory.SharedMemory(name=name)
+    _noise = np.ndarray(shape, dtype=dtype, buffer=_shm.buf)
+
+
+def mix_file(stim_file, offsets, snrs, noise_sr, silence, rescale, save):
+    name = os.path.basename(stim_file)
+    stim, stim_sr = librosa.load(stim_file, sr=None)
+    stim = pad_silence(stim, stim_sr, silence)
+
+    assert noise_sr == stim_sr
+    assert len(_noise) >= len(stim)
+
+    segments = _noise[offsets[:, None] + np.arange(len(stim))]
+    mixed = mix_v2_batch(stim, segments, snrs)
+    if rescale:
+        mixed = scale_to_target_dbfs(mixed, TEST_DBFS, axis=1)
+
+    if save:
+        with ThreadPoolExecutor() as writer:
+            for snr, y in zip(snrs, mixed):
+                save_dir = os.path.join(TEST_FOLDER, f'snr{snr:+03d}')
+                os.makedirs(save_dir, exist_ok=True)
+                writer.submit(sf.write, os.path.join(save_dir, name), y, stim_sr)
+    return name, rms_db(stim), rms_db(mixed, axis=1)
             
 
 if __name__ == "__main__":
@@ -51,43 +114,33 @@ if __name__ == "__main__":
     parser.add_argument("--dont_rescale", action='store_true')
     parser.add_argument("--silence", type=float, default=.0)
     parser.add_argument("--save", action='store_true')
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
     args = parser.parse_args()
     
     np.random.seed(1993)
     
     noise, noise_sr = librosa.load(NOISE_FILE, sr=None)
-    
     print("db_noise", rms_db(noise))
-    for stim_file in sorted(SOURCE_FILES):    
-        name = os.path.basename(stim_file)
-        stim, stim_sr = librosa.load(stim_file, sr=None)
-        
-        stim = np.r_[
-            np.zeros(int(stim_sr * args.silence)),
-            stim,
-            np.zeros(int(stim_sr * args.silence)),
-        ]
-        
-        assert noise_sr == stim_sr
-        assert len(noise) >= len(stim)
-        
-        print(name, "db ->", rms_db(stim))        
-        
-        for snr in range(args.min_snr, args.max_snr + args.increment, args.increment):
-            print("mixing to snr", snr)
-            
-            start = np.random.randint(0, len(noise) - len(stim))
-            noise_segment = noise[start:start+len(stim)].copy()
-            mixed = mix_v2(stim, noise_segment, snr)
-                        
-            print(rms_db(mixed))
-            if not args.dont_rescale:
-                mixed = scale_to_target_dbfs(mixed, TEST_DBFS)
-                print(rms_db(mixed))
-                
-            if args.save:
-                save_dir = os.path.join(TEST_FOLDER, f'snr{snr:+03d}')
-                if not os.path.isdir(save_dir):
-                    os.makedirs(save_dir)
-                
-                sf.write(os.path.join(save_dir, name), mixed, stim_sr)
\ No newline at end of file
+
+    stim_files = sorted(SOURCE_FILES)
+    snrs = list(range(args.min_snr, args.max_snr + args.increment, args.increment))
+    offsets = draw_offsets(stim_files, len(noise), snrs, args.silence)
+
+    shm = shared_memory.SharedMemory(create=True, size=noise.nbytes)
+    try:
+        np.ndarray(noise.shape, dtype=noise.dtype, buffer=shm.buf)[:] = noise
+        init_args = (shm.name, noise.shape, noise.dtype)
+        with ProcessPoolExecutor(args.jobs, initializer=_attach_noise, initargs=init_args) as pool:
+            jobs = [
+                pool.submit(
+                    mix_file, stim_file, file_offsets, snrs, noise_sr, 
+                    args.silence, not args.dont_rescale, args.save
+                )
+                for stim_file, file_offsets in zip(stim_files, offsets)
+            ]
+            for job in jobs:
+                name, db_stim, db_mixed = job.result()
+                print(name, "db ->", db_stim, "mixed db", np.round(db_mixed, 2))
+    finally:
+        shm.close()
+        shm.unlink()
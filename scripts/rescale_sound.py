@@ -1,7 +1,8 @@
 import os
 import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-import librosa
 import soundfile as sf
 import numpy as np
 
@@ -10,26 +11,105 @@ LOUD_DBFS = -15
 TEST_DBFS = -20 
 SOFT_DBFS = -40
 FS = 44100
+BLOCK_SIZE = 1 << 16
 
 
-def rms_db(y):
-    rms = np.sqrt(np.mean(y**2))
+def rms_db(y, axis=None, keepdims=False):
+    rms = np.sqrt(np.mean(y**2, axis=axis, keepdims=keepdims))
     return 20 * np.log10(rms)
 
-def scale_to_target_dbfs(y, target_dbfs):
-    current_dbfs = rms_db(y)
+def scale_to_target_dbfs(y, target_dbfs, axis=None):
+    current_dbfs = rms_db(y, axis=axis, keepdims=axis is not None)
     diff = target_dbfs - current_dbfs
     gain = 10 ** (diff / 20)
     return y * gain
     
 def rescale(path, db, save = None):
+    import librosa
+    
     y, sr = librosa.load(path, sr=FS)
-    print(rms_db(y))
     y_scaled = scale_to_target_dbfs(y, db)
-    print(rms_db(y_scaled))
     
     if save:
         sf.write(save, y_scaled, FS)
+    return rms_db(y), rms_db(y_scaled)
+
+
+def read_mono_blocks(path, block_size=BLOCK_SIZE):
+    with sf.SoundFile(path) as f:
+        for block in f.blocks(blocksize=block_size, dtype="float32", always_2d=True):
+            yield block.mean(axis=1)
+
+
+def power_db(blocks):
+    n, energy = 0, 0.0
+    for block in blocks:
+        n += len(block)
+        energy += np.dot(block, block.astype(np.float64))
+    return 10 * np.log10(energy / n)
+
+
+def rescale_blocks(path, db, save=None, block_size=BLOCK_SIZE):
+    """Rescale a file to db while holding only one block in memory.
+
+    Files that are not sampled at FS are resampled by rescale instead. The
+    level before is measured on the source file in both cases. The output
+    is written to a temporary file first, so save may equal path.
+    """
+    db_before = power_db(read_mono_blocks(path, block_size))
+    if sf.info(path).samplerate != FS:
+        return db_before, rescale(path, db, save)[1]
+
+    gain = np.float32(10 ** ((db - db_before) / 20))
+    if not save:
+        return db_before, db_before + 20 * np.log10(gain)
+
+    def scaled_blocks():
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(save)), suffix=".wav")
+        os.close(fd)
+        try:
+            with sf.SoundFile(tmp, "w", samplerate=FS, channels=1, format="WAV") as out:
+                for block in read_mono_blocks(path, block_size):
+                    block = block * gain
+                    out.write(block)
+                    yield block
+            os.replace(tmp, save)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    
+    return db_before, power_db(scaled_blocks())
+
+
+def iter_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for f in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, f), root)
+
+
+def rescale_tree(root, db, save=None, jobs=None):
+    """Rescale every file below root in parallel, mirroring the tree in save.
+
+    Returns a list of (relative path, db before, db after) and a list of
+    (relative path, error) for the files that could not be rescaled.
+    """
+    results, failures = [], []
+    with ProcessPoolExecutor(jobs) as pool:
+        jobs = {}
+        for rel in iter_files(root):
+            target = None
+            if save is not None:
+                target = os.path.join(save, rel)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            jobs[rel] = pool.submit(rescale_blocks, os.path.join(root, rel), db, target)
+        
+        for rel, job in jobs.items():
+            try:
+                results.append((rel, *job.result()))
+            except Exception as err:
+                failures.append((rel, err))
+    return results, failures
         
 
 if __name__ == "__main__":
@@ -39,6 +119,7 @@ if __name__ == "__main__":
     parser.add_argument("--loud", action='store_true')
     parser.add_argument("--save", type=str, default=None)
     parser.add_argument("--save_inplace", action='store_true')
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
     args = parser.parse_args()
     
     
@@ -53,24 +134,13 @@ if __name__ == "__main__":
         args.save = args.path
     
     if os.path.isfile(args.path):   
-        rescale(args.path, db, args.save)
+        db_before, db_after = rescale_blocks(args.path, db, args.save)
+        print(f"{args.path}: {db_before:.2f} dB -> {db_after:.2f} dB")
 
     if os.path.isdir(args.path):
-        if args.save and not os.path.isdir(args.save):
-            os.makedirs(args.save)
-        
-        for f in os.listdir(args.path):
-            path = os.path.join(args.path, f)
-            save = args.save if args.save is None else os.path.join(args.save, f)
-            if os.path.isfile(path):
-                rescale(path, db, save)
-            elif os.path.isdir(path):
-                for f in os.listdir(path):
-                    f_path = os.path.join(path, f)
-                    f_save = args.save if args.save is None else os.path.join(save, f)
-                    if os.path.isfile(f_path):
-                        try:
-                            rescale(f_path, db, f_save)
-                        except:
-                            print(f_path)
-        
+        results, failures = rescale_tree(args.path, db, args.save, args.jobs)
+        for rel, db_before, db_after in results:
+            print(f"{rel}: {db_before:.2f} dB -> {db_after:.2f} dB")
+        for rel, err in failures:
+            print(f"FAILED {rel}: {err}")
+        print(f"rescaled {len(results)} files, {len(failures)} failures")
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.settings")
+# connections are opened on sync_to_async threads, close them after every request
+os.environ.setdefault("DIN_CONN_MAX_AGE", "0")
 
 application = get_asgi_application()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 import socket
 from pathlib import Path
 
@@ -51,6 +52,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "din.metrics.MetricsMiddleware",
+    "din.middleware.DatabaseLockedMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -93,6 +96,19 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {
+            # WAL lets readers continue while a worker writes, IMMEDIATE takes the
+            # write lock at the start of a transaction so waiting for it honours
+            # the busy timeout (seconds) instead of failing with "database is locked"
+            "init_command": "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;",
+            "transaction_mode": "IMMEDIATE",
+            "timeout": 20,
+        },
+        # persistent connections only pay off for WSGI workers, settings/wsgi.py
+        # defaults this to 60. Under ASGI connections opened on sync_to_async
+        # threads would be kept open without being reused, so it is 0 there
+        "CONN_MAX_AGE": int(os.environ.get("DIN_CONN_MAX_AGE", 0)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
@@ -141,6 +157,34 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Hand media files to the web server instead of streaming them from Django,
+# either "X-Accel-Redirect" (nginx, internal location MEDIA_ACCEL_PREFIX) or "X-Sendfile"
+MEDIA_SENDFILE_HEADER = None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+FIGURE_CACHE_DIR = BASE_DIR / 'cache' / 'figures'
+FIGURE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+SNAPSHOT_DIR = BASE_DIR / 'cache' / 'snapshot'
+
+REPORT_CACHE_DIR = BASE_DIR / 'cache' / 'report'
+
+# Background jobs (din.jobs), run by `manage.py run_jobs`, which must be running
+# for summaries and figures to appear. Eager jobs run in the process that queues
+# them instead, including the participant's last answer, so only for development
+JOBS_EAGER = os.environ.get("DIN_JOBS_EAGER", "0") == "1"
+# seconds after which a running job is considered lost and run again
+JOBS_TIMEOUT = 300
+JOBS_MAX_ATTEMPTS = 3
+# days finished jobs are kept
+JOBS_KEEP_DAYS = 7
+
+METRICS_DIR = BASE_DIR / 'cache' / 'metrics'
+METRICS_FLUSH_INTERVAL = 5
+# requests taking longer (seconds) are logged with their slowest queries
+METRICS_SLOW_REQUEST = 0.5
+# bearer token for scraping /metrics without a staff login
+METRICS_TOKEN = os.environ.get("DIN_METRICS_TOKEN")
 
 
 if not DEBUG:
@@ -152,6 +196,11 @@ if not DEBUG:
                 'class': 'logging.FileHandler',
                 'filename': BASE_DIR / 'logs/django_errors.log',
             },
+            'slow': {
+                'level': 'WARNING',
+                'class': 'logging.FileHandler',
+                'filename': BASE_DIR / 'logs/slow_requests.log',
+            },
         },
         'loggers': {
             'django': {
@@ -159,5 +208,9 @@ if not DEBUG:
                 'level': 'ERROR',
                 'propagate': True,
             },
+            'din.metrics': {
+                'handlers': ['slow'],
+                'level': 'WARNING',
+            },
         },
 }
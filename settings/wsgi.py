@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.settings")
+# keep database connections between the requests of a worker
+os.environ.setdefault("DIN_CONN_MAX_AGE", "60")
 
 application = get_wsgi_application()